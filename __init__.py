@@ -54,16 +54,23 @@ bl_info = {
     "category": "Characters"
 }
 
-mblab_humanoid = humanoid.Humanoid(bl_info["version"])
+mblab_proxy = proxyengine.ProxyEngine()
+mblab_humanoid = humanoid.Humanoid(bl_info["version"], mblab_proxy)
 mblab_retarget = animationengine.RetargetEngine()
 mblab_shapekeys = animationengine.ExpressionEngineShapeK()
-mblab_proxy = proxyengine.ProxyEngine()
 
 gui_status = "NEW_SESSION"
 gui_err_msg = ""
 gui_active_panel = None
 gui_active_panel_fin = None
 
+REALTIME_UPDATE_INTERVAL = 1/30
+REALTIME_FINISH_DELAY = 0.3
+
+realtime_pending_categories = set()
+realtime_last_change = 0.0
+realtime_preview_pending = False
+
 
 def start_lab_session():
     global mblab_humanoid
@@ -186,14 +193,51 @@ def realtime_update(self, context):
     Update the character while the prop slider moves.
     """
     global mblab_humanoid
+    global realtime_last_change
     if mblab_humanoid.bodydata_realtime_activated:
         # time1 = time.time()
         scn = bpy.context.scene
-        mblab_humanoid.update_character(category_name=scn.morphingCategory, mode="update_realtime")
-        mblab_humanoid.sync_gui_according_measures()
+        if scn.mblab_realtime_preview:
+            # The changes are applied by realtime_update_timer
+            realtime_pending_categories.add(scn.morphingCategory)
+            realtime_last_change = time.time()
+            if not bpy.app.timers.is_registered(realtime_update_timer):
+                bpy.app.timers.register(realtime_update_timer, first_interval=REALTIME_UPDATE_INTERVAL)
+        else:
+            mblab_humanoid.update_character(category_name=scn.morphingCategory, mode="update_realtime")
+            mblab_humanoid.sync_gui_according_measures(changed_only=True)
         # print("realtime_update: {0}".format(time.time()-time1))
 
 
+def realtime_update_timer():
+    """
+    Apply the slider changes collected since the last call in
+    preview mode, at most once every REALTIME_UPDATE_INTERVAL.
+    Blender doesn't tell when the slider is released, so the full
+    update is done when no change comes for REALTIME_FINISH_DELAY.
+    """
+    global mblab_humanoid
+    global realtime_preview_pending
+    if gui_status != "ACTIVE_SESSION" or not mblab_humanoid.get_object():
+        realtime_pending_categories.clear()
+        realtime_preview_pending = False
+        return None
+
+    if realtime_pending_categories:
+        for category_name in sorted(realtime_pending_categories):
+            mblab_humanoid.update_character(category_name=category_name, mode="update_preview")
+        realtime_pending_categories.clear()
+        realtime_preview_pending = True
+
+    if time.time()-realtime_last_change < REALTIME_FINISH_DELAY:
+        return REALTIME_UPDATE_INTERVAL
+
+    if realtime_preview_pending:
+        mblab_humanoid.finish_preview_update()
+        realtime_preview_pending = False
+    return None
+
+
 def age_update(self, context):
     global mblab_humanoid
     time1 = time.time()
@@ -600,6 +644,11 @@ bpy.types.Scene.mblab_expression_filter = bpy.props.StringProperty(
     default="",
     description="过滤要显示的表达式")
 
+bpy.types.Scene.mblab_realtime_preview = bpy.props.BoolProperty(
+    name="快速预览",
+    default=True,
+    description="拖动滑块时跳过尺寸和骨架的更新，停止后再完整更新")
+
 bpy.types.Scene.mblab_mix_characters = bpy.props.BoolProperty(
     name="与当前的混合",
     description="混合模板")
@@ -624,6 +673,11 @@ bpy.types.Scene.mblab_transfer_proxy_weights = bpy.props.BoolProperty(
     description="如果替代物已经装配了权重，它们将被替换为从角色主体投射的权重",
     default=True)
 
+bpy.types.Scene.mblab_proxy_live_refit = bpy.props.BoolProperty(
+    name="替代物实时跟随角色",
+    description="修改角色时，已适配的替代物跟随身体移动，无需重新适配",
+    default=False)
+
 bpy.types.Scene.mblab_save_images_and_backup = bpy.props.BoolProperty(
     name="保存图像并备份角色",
     description="保存皮肤着色器中的所有图像，并以 json 格式备份角色",
@@ -1582,6 +1636,26 @@ class FitProxy(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class FitProxies(bpy.types.Operator):
+    bl_label = '适配所有选中的替代物'
+    bl_idname = 'mbast.proxies_fit'
+    bl_description = '一次性使所有选中的网格适合角色'
+    bl_context = 'objectmode'
+    bl_options = {'REGISTER', 'INTERNAL'}
+
+    def execute(self, context):
+        scn = bpy.context.scene
+        offset = scn.mblab_proxy_offset / 1000
+        threshold = scn.mblab_proxy_threshold / 1000
+        status, proxies, body = mblab_proxy.get_proxies_fitting_ingredients()
+        if status != "OK":
+            self.report({'WARNING'}, "没有可以适配的替代物")
+            return {'CANCELLED'}
+        mblab_proxy.fit_proxy_objects(
+            body, proxies, offset, threshold, scn.mblab_add_mask_group, scn.mblab_transfer_proxy_weights)
+        return {'FINISHED'}
+
+
 class RemoveProxy(bpy.types.Operator):
     bl_label = '移除配件'
     bl_idname = 'mbast.proxy_removefit'
@@ -1934,7 +2008,9 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
                     box.prop(scn, 'mblab_proxy_threshold')
                     box.prop(scn, 'mblab_add_mask_group')
                     box.prop(scn, 'mblab_transfer_proxy_weights')
+                    box.prop(scn, 'mblab_proxy_live_refit')
                     box.operator("mbast.proxy_fit", icon="MOD_CLOTH")
+                    box.operator("mbast.proxies_fit", icon="MOD_CLOTH")
                     box.operator("mbast.proxy_removefit", icon="MOD_CLOTH")
                 if fitting_status == 'WRONG_SELECTION':
                     box.enabled = False
@@ -2059,6 +2135,7 @@ class VIEW3D_PT_tools_ManuelbastioniLAB(bpy.types.Panel):
 
                     box = self.layout.box()
                     mblab_humanoid.bodydata_realtime_activated = True
+                    box.prop(scn, 'mblab_realtime_preview')
                     if mblab_humanoid.exists_measure_database():
                         box.prop(scn, 'mblab_show_measures')
                     split = box.split()
@@ -2274,6 +2351,7 @@ classes = (
     LoadDermImage,
     LoadDispImage,
     FitProxy,
+    FitProxies,
     RemoveProxy,
     ApplyMeasures,
     AutoModelling,
@@ -2304,6 +2382,9 @@ def register():
 
 
 def unregister():
+    if bpy.app.timers.is_registered(realtime_update_timer):
+        bpy.app.timers.unregister(realtime_update_timer)
+
     # addon updater unregister
     addon_updater_ops.unregister()
 
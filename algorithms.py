@@ -28,7 +28,10 @@ import time
 import os
 import json
 import array
+import struct
+from functools import lru_cache
 
+import numpy as np
 import mathutils
 import bpy
 
@@ -38,6 +41,13 @@ logger = logging.getLogger(__name__)
 
 DEBUG_LEVEL = 3
 
+ARRAYS_FILE_MAGIC = b"MBLABDB1"
+ARRAYS_FILE_EXTENSION = ".mbdb"
+ARRAYS_FILE_ALIGNMENT = 64
+
+# Number of databases kept in memory by load_cached_database
+DATABASE_CACHE_SIZE = 32
+
 
 def print_log_report(level, text_to_write):
     import warnings
@@ -113,21 +123,6 @@ def quick_dist(p_1, p_2):
     return ((p_1[0]-p_2[0])**2) + ((p_1[1]-p_2[1])**2) + ((p_1[2]-p_2[2])**2)
 
 
-def full_dist(vert1, vert2, axis="ALL"):
-    v1 = mathutils.Vector(vert1)
-    v2 = mathutils.Vector(vert2)
-
-    if axis not in {"X", "Y", "Z"}:
-        v3 = v1 - v2
-        return v3.length
-    if axis == "X":
-        return abs(v1[0]-v2[0])
-    if axis == "Y":
-        return abs(v1[1]-v2[1])
-    # if axis == "Z":
-    return abs(v1[2]-v2[2])
-
-
 def exists_database(lib_path):
     result = False
     if simple_path(lib_path) != "":
@@ -144,15 +139,6 @@ def exists_database(lib_path):
             logger.warning("未找到数据路径 %s", simple_path(lib_path))
     return result
 
-# TODO: This may be the data input we are looking for?
-def length_of_strip(vertices_coords, indices, axis="ALL"):
-    strip_length = 0
-    for x in range(len(indices)-1):
-        v1 = vertices_coords[indices[x]]
-        v2 = vertices_coords[indices[x+1]]
-        strip_length += full_dist(v1, v2, axis)
-    return strip_length
-
 
 def function_modifier_a(val_x):
     return 2 * val_x - 1 if val_x > 0.5 else 0.0
@@ -162,45 +148,6 @@ def function_modifier_b(val_x):
     return 1-2 * val_x if val_x < 0.5 else 0.0
 
 
-def bounding_box(verts_coo, indices, roundness=4):
-
-    val_x, val_y, val_z = [], [], []
-    for idx in indices:
-        if len(verts_coo) > idx:
-            val_x.append(verts_coo[idx][0])
-            val_y.append(verts_coo[idx][1])
-            val_z.append(verts_coo[idx][2])
-        else:
-            logger.warning("计算边界框时出错：索引 %s 不在 verts_coo 中 (len(verts_coo) = %s))",
-                           idx, len(verts_coo))
-            return None
-
-    box_x = round(max(val_x)-min(val_x), roundness)
-    box_y = round(max(val_y)-min(val_y), roundness)
-    box_z = round(max(val_z)-min(val_z), roundness)
-
-    return (box_x, box_y, box_z)
-
-
-def get_bounding_box(v_coords):
-
-    if v_coords:
-
-        val_x, val_y, val_z = [], [], []
-        for coord in v_coords:
-            val_x.append(coord[0])
-            val_y.append(coord[1])
-            val_z.append(coord[2])
-
-        box_x = max(val_x)-min(val_x)
-        box_y = max(val_y)-min(val_y)
-        box_z = max(val_z)-min(val_z)
-
-        return (box_x, box_y, box_z)
-
-    return None
-
-
 def load_bbox_data(filepath):
     bboxes = []
     database_file = open(filepath, "r")
@@ -314,63 +261,10 @@ def polygon_forma(list_of_verts):
     return form_factors
 
 
-def average_center(verts_coords):
-
-    n_verts = len(verts_coords)
-    bcenter = mathutils.Vector((0.0, 0.0, 0.0))
-    if n_verts != 0:
-        for v_coord in verts_coords:
-            bcenter += v_coord
-        bcenter = bcenter/n_verts
-    return bcenter
-
-
 def linear_interpolation_y(xa, xb, ya, yb, y):
     return (((xa-xb)*y)+(xb*ya)-(xa*yb))/(ya-yb)
 
 
-def correct_morph(base_form, current_form, morph_deltas, bboxes):
-    time1 = time.time()
-    new_morph_deltas = []
-    for d_data in morph_deltas:
-
-        idx = d_data[0]
-
-        if str(idx) in bboxes:
-            indices = bboxes[str(idx)]
-            current_bounding_box = bounding_box(current_form, indices)
-            if current_bounding_box:
-                base_bounding_box = bounding_box(base_form, indices)
-                if base_bounding_box:
-
-                    if base_bounding_box[0] != 0:
-                        scale_x = current_bounding_box[0]/base_bounding_box[0]
-                    else:
-                        scale_x = 1
-
-                    if base_bounding_box[1] != 0:
-                        scale_y = current_bounding_box[1]/base_bounding_box[1]
-                    else:
-                        scale_y = 1
-
-                    if base_bounding_box[2] != 0:
-                        scale_z = current_bounding_box[2]/base_bounding_box[2]
-                    else:
-                        scale_z = 1
-
-                    delta_x = d_data[1][0] * scale_x
-                    delta_y = d_data[1][1] * scale_y
-                    delta_z = d_data[1][2] * scale_z
-
-                    newd = mathutils.Vector((delta_x, delta_y, delta_z))
-                    new_morph_deltas.append([idx, newd])
-        else:
-            new_morph_deltas.append(d_data)
-            logger.warning("索引 %s 不在边界框数据库中", idx)
-    logger.info("变形已在 %s 秒内被修正", time.time()-time1)
-    return new_morph_deltas
-
-
 def check_version(m_vers, min_version=(1, 5, 0)):
 
     # m_vers can be a list, tuple, IDfloatarray or str
@@ -472,20 +366,319 @@ def load_json_data(json_path, description=None):
     return None
 
 
-def less_boundary_verts(obj, verts_idx, iterations=1):
-    polygons = obj.data.polygons
+@lru_cache(maxsize=DATABASE_CACHE_SIZE)
+def _cached_database(loader, filepath, mtime, args):
+    return loader(filepath, *args)
+
+
+def load_cached_database(filepath, loader, *args):
+    """
+    Return loader(filepath, *args), sharing the result with all the
+    previous calls for the same unchanged file, also across
+    characters and scene reloads. The returned data must be
+    treated as read-only. A folder is keyed on its own mtime only,
+    the files inside are checked when the loader runs.
+    """
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        mtime = None
+    return _cached_database(loader, filepath, mtime, args)
+
+
+def clear_database_cache():
+    _cached_database.cache_clear()
+
+
+def get_compiled_path(source_path):
+    return os.path.splitext(source_path)[0] + ARRAYS_FILE_EXTENSION
+
+
+def get_source_mtime(source_path):
+    """
+    The modification time of a source file. For a folder it's the
+    newest time of the folder and its json files, because a file
+    overwritten in place doesn't change the time of the folder.
+    """
+    mtime = os.path.getmtime(source_path)
+    if os.path.isdir(source_path):
+        with os.scandir(source_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+def is_compiled_file_valid(source_path, compiled_path):
+    """
+    A compiled file can be used if it's not older than its source.
+    If the source is missing, the compiled file is used as it is.
+    """
+    if not os.path.isfile(compiled_path):
+        return False
+    if not os.path.exists(source_path):
+        return True
+    return os.path.getmtime(compiled_path) >= get_source_mtime(source_path)
+
+
+def _aligned(offset):
+    return -(-offset // ARRAYS_FILE_ALIGNMENT) * ARRAYS_FILE_ALIGNMENT
+
+
+def save_arrays_file(filepath, header, arrays):
+    """
+    Write a json header and a dict of numpy arrays in a single
+    binary file that load_arrays_file can memory-map.
+    """
+    time1 = time.time()
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+
+    header_bytes = json.dumps({"header": header, "arrays": layout}).encode("utf-8")
+    data_start = _aligned(len(ARRAYS_FILE_MAGIC) + 8 + len(header_bytes))
+
+    # Write to a temporary file first, so a crash can't leave a broken database
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "wb") as a_file:
+        a_file.write(ARRAYS_FILE_MAGIC)
+        a_file.write(struct.pack("<Q", len(header_bytes)))
+        a_file.write(header_bytes)
+        for name, arr in arrays.items():
+            a_file.write(b"\0" * (data_start + layout[name]["offset"] - a_file.tell()))
+            a_file.write(arr.tobytes())
+    os.replace(tmp_filepath, filepath)
+    logger.info("二进制数据库 %s 在 %s 秒内保存", simple_path(filepath), time.time()-time1)
+
+
+def load_arrays_file(filepath, use_mmap=True):
+    """
+    Read a file written by save_arrays_file. With use_mmap the arrays
+    are read-only views on a memory-mapped file, so the pages are
+    loaded on demand.
+    Return (header, arrays) or (None, None) in case of error.
+    """
+    try:
+        time1 = time.time()
+        with open(filepath, "rb") as a_file:
+            if a_file.read(len(ARRAYS_FILE_MAGIC)) != ARRAYS_FILE_MAGIC:
+                logger.warning("二进制数据库格式错误：%s", simple_path(filepath))
+                return None, None
+            header_len = struct.unpack("<Q", a_file.read(8))[0]
+            file_header = json.loads(a_file.read(header_len).decode("utf-8"))
+        data_start = _aligned(len(ARRAYS_FILE_MAGIC) + 8 + header_len)
+
+        if use_mmap:
+            buffer = np.memmap(filepath, dtype=np.uint8, mode="r")
+        else:
+            buffer = np.fromfile(filepath, dtype=np.uint8)
+            buffer.flags.writeable = False
+
+        arrays = {}
+        for name, layout in file_header["arrays"].items():
+            dtype = np.dtype(layout["dtype"])
+            shape = tuple(layout["shape"])
+            start = data_start + layout["offset"]
+            n_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            arrays[name] = buffer[start:start+n_bytes].view(dtype).reshape(shape)
+        logger.info("二进制数据库 %s 在 %s 秒内加载", simple_path(filepath), time.time()-time1)
+        return file_header["header"], arrays
+    except (IOError, ValueError, KeyError, struct.error):
+        logger.warning("二进制数据库中的错误：%s", simple_path(filepath))
+    return None, None
+
+
+class VertexGroupsWeights:
+    """
+    Sparse weights of a set of vertex groups, stored by group: the
+    group names[g] has the verts indices[offsets[g]:offsets[g+1]]
+    with the weights[offsets[g]:offsets[g+1]]. weighted is False
+    for the verts stored without a weight.
+    """
+
+    def __init__(self, names, offsets, indices, weights, weighted=None):
+        self.names = list(names)
+        self.group_ids = {name: i for i, name in enumerate(self.names)}
+        self.offsets = offsets
+        self.indices = indices
+        self.weights = weights
+        if weighted is None:
+            weighted = np.ones(len(indices), dtype=np.bool_)
+        self.weighted = weighted
+
+    @classmethod
+    def from_json_data(cls, g_data):
+        """
+        Convert the vgroups json format, where each group is a list
+        of [index, weight] pairs or of indices with weight 1.0.
+        """
+        names = list(g_data.keys())
+        indices = []
+        weights = []
+        weighted = []
+        counts = []
+        for group_name in names:
+            count = 0
+            for vert_data in g_data[group_name]:
+                if isinstance(vert_data, list):
+                    indices.append(vert_data[0])
+                    weights.append(vert_data[1])
+                    weighted.append(True)
+                    count += 1
+                elif isinstance(vert_data, int):
+                    indices.append(vert_data)
+                    weights.append(1.0)
+                    weighted.append(False)
+                    count += 1
+                else:
+                    logger.info("错误：顶点组的格式错误")
+            counts.append(count)
+        offsets = np.zeros(len(names)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(
+            names, offsets,
+            np.array(indices, dtype=np.int32),
+            np.array(weights, dtype=np.float32),
+            np.array(weighted, dtype=np.bool_))
+
+    @classmethod
+    def from_object(cls, obj):
+        """
+        Read all the vertex groups of obj with a single pass over
+        the vertices, instead of asking each group for each vertex.
+        """
+        names = [grp.name for grp in obj.vertex_groups]
+        groups_ids = array.array('i')
+        indices = array.array('i')
+        weights = array.array('f')
+        for vert in obj.data.vertices:
+            for g in vert.groups:
+                groups_ids.append(g.group)
+                indices.append(vert.index)
+                weights.append(g.weight)
+        groups_ids = np.frombuffer(groups_ids, dtype=np.int32)
+        order = np.argsort(groups_ids, kind="stable")
+        offsets = np.zeros(len(names)+1, dtype=np.int64)
+        np.cumsum(np.bincount(groups_ids, minlength=len(names)), out=offsets[1:])
+        return cls(
+            names, offsets,
+            np.frombuffer(indices, dtype=np.int32)[order],
+            np.frombuffer(weights, dtype=np.float32)[order])
+
+    @classmethod
+    def load(cls, filepath, use_mmap=True):
+        header, arrays = load_arrays_file(filepath, use_mmap)
+        if header and header.get("type") == "vgroups" and "weighted" in arrays:
+            return cls(header["names"], arrays["offsets"], arrays["indices"], arrays["weights"], arrays["weighted"])
+        return None
+
+    def save(self, filepath):
+        header = {"type": "vgroups", "names": self.names}
+        arrays = {
+            "offsets": self.offsets, "indices": self.indices,
+            "weights": self.weights, "weighted": self.weighted}
+        save_arrays_file(filepath, header, arrays)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, group_name):
+        return group_name in self.group_ids
+
+    def group(self, group_name):
+        g_id = self.group_ids[group_name]
+        start = self.offsets[g_id]
+        end = self.offsets[g_id+1]
+        return (self.indices[start:end], self.weights[start:end])
+
+    def get_verts_rows(self, n_verts):
+        """
+        Return the same weights as a (n_verts x n_groups) matrix
+        stored by vertex: the CSR arrays (offsets, groups_ids, weights).
+        """
+        groups_ids = np.repeat(np.arange(len(self.names), dtype=np.int32), np.diff(self.offsets))
+        valid = self.indices < n_verts
+        order = np.argsort(self.indices[valid], kind="stable")
+        offsets = np.zeros(n_verts+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices[valid], minlength=n_verts), out=offsets[1:])
+        return offsets, groups_ids[valid][order], self.weights[valid][order]
+
+    def add_to_object(self, obj, use_weights=True):
+        """
+        Create the groups in obj. The verts with the same weight are
+        added with a single call. With use_weights only the verts
+        stored with a weight are added, otherwise only the others.
+        """
+        for group_name in sorted(self.names):
+            new_group = new_vertgroup(obj, group_name)
+            indices, weights = self.group(group_name)
+            g_id = self.group_ids[group_name]
+            weighted = self.weighted[self.offsets[g_id]:self.offsets[g_id+1]]
+            if use_weights:
+                if not weighted.all():
+                    logger.info("错误：垂直权重格式错误")
+                add_vertgroup_weights(new_group, indices[weighted], weights[weighted])
+            else:
+                if weighted.any():
+                    logger.info("错误：顶点组的格式错误")
+                new_group.add(indices[~weighted].tolist(), 1.0, 'REPLACE')
+
+
+def add_vertgroup_weights(vertgroup, indices, weights):
+    """
+    Add the verts to the group with one call for each distinct weight.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    order = np.argsort(weights, kind="stable")
+    buckets_starts = np.flatnonzero(np.diff(weights[order])) + 1
+    for bucket in np.split(order, buckets_starts):
+        if len(bucket):
+            vertgroup.add(np.asarray(indices)[bucket].tolist(), float(weights[bucket[0]]), 'REPLACE')
+
+
+def compile_vertgroups_database(vgroup_data_path):
+    """
+    Convert a json vgroups database in the binary format read by
+    load_vertgroups_database. Return the new groups.
+    """
+    g_data = load_json_data(vgroup_data_path, "Vertgroups data")
+    if not g_data:
+        return None
+    vgroups = VertexGroupsWeights.from_json_data(g_data)
+    try:
+        vgroups.save(get_compiled_path(vgroup_data_path))
+    except OSError:
+        logger.warning("无法写入二进制数据库 %s", simple_path(vgroup_data_path))
+    return vgroups
+
+
+def load_vertgroups_database(vgroup_data_path):
+    compiled_path = get_compiled_path(vgroup_data_path)
+    if is_compiled_file_valid(vgroup_data_path, compiled_path):
+        vgroups = VertexGroupsWeights.load(compiled_path)
+        if vgroups is not None:
+            return vgroups
+    return compile_vertgroups_database(vgroup_data_path)
+
 
+def less_boundary_verts_mask(verts_mask, polygons_verts, polygons_offsets, iterations=1):
+    """
+    Remove from the boolean mask of the verts all the verts of the
+    polygons that are not entirely in it, for the given iterations.
+    The polygons are as returned by get_polygons_verts.
+    """
+    if len(polygons_offsets) < 2:
+        return verts_mask
+    polygons_sizes = np.diff(polygons_offsets)
     while iterations != 0:
-        verts_to_remove = set()
-        for poly in polygons:
-            poly_verts_idx = poly.vertices
-            for v_idx in poly_verts_idx:
-                if v_idx not in verts_idx:
-                    for _v_idx in poly_verts_idx:
-                        verts_to_remove.add(_v_idx)
-                    break
-        verts_idx.difference_update(verts_to_remove)
+        polygons_out = np.logical_or.reduceat(~verts_mask[polygons_verts], polygons_offsets[:-1])
+        verts_mask[polygons_verts[np.repeat(polygons_out, polygons_sizes)]] = False
         iterations -= 1
+    return verts_mask
 
 
 def kdtree_from_mesh_polygons(mesh):
@@ -497,20 +690,35 @@ def kdtree_from_mesh_polygons(mesh):
     return research_tree
 
 
-def kdtree_from_obj_polygons(obj, indices_of_polygons_subset=None):
-    polygons = []
-    if indices_of_polygons_subset is not None:
-        for idx in indices_of_polygons_subset:
-            polygons.append(obj.data.polygons[idx])
-    else:
-        polygons = obj.data.polygons
-    research_tree = mathutils.kdtree.KDTree(len(polygons))
-    for polyg in polygons:
-        research_tree.insert(polyg.center, polyg.index)
+def kdtree_from_coords(coords, indices=None):
+    """
+    Build a kdtree of the (N, 3) coords, with the given indices
+    or with the row numbers.
+    """
+    if indices is None:
+        indices = range(len(coords))
+    research_tree = mathutils.kdtree.KDTree(len(coords))
+    for idx, co in zip(indices, np.asarray(coords).tolist()):
+        research_tree.insert(co, idx)
     research_tree.balance()
     return research_tree
 
 
+def kdtree_find_n(research_tree, coords, n):
+    """
+    Run find_n for all the (N, 3) coords. Return the (N, n) arrays
+    of the found indices and distances, nearest first, padded with
+    -1 and inf where less than n items were found.
+    """
+    found_indices = np.full((len(coords), n), -1, dtype=np.int64)
+    found_dists = np.full((len(coords), n), np.inf)
+    for i, co in enumerate(np.asarray(coords).tolist()):
+        for j, (found_co, found_idx, found_dist) in enumerate(research_tree.find_n(co, n)):
+            found_indices[i, j] = found_idx
+            found_dists[i, j] = found_dist
+    return found_indices, found_dists
+
+
 def kdtree_from_mesh_vertices(mesh):
     vertices = mesh.vertices
     research_tree = mathutils.kdtree.KDTree(len(vertices))
@@ -535,26 +743,6 @@ def get_scene_modifiers_status():
     return scene_viewport_status
 
 
-def get_polygon_vertices_coords(obj_data, index):
-
-    if is_object(obj_data):
-        polygon = obj_data.data.polygons[index]
-    elif is_mesh(obj_data):
-        polygon = obj_data.polygons[index]
-
-    polygon_vindex = polygon.vertices
-    verts_coords = []
-
-    for i in polygon_vindex:
-        if is_object(obj_data):
-            v = obj_data.data.vertices[i]
-        elif is_mesh(obj_data):
-            v = obj_data.vertices[i]
-        verts_coords.append(v.co)
-
-    return verts_coords
-
-
 def remove_mesh(mesh, remove_materials=False):
     if remove_materials:
         for material in mesh.materials:
@@ -962,10 +1150,13 @@ def new_shapekey(obj, shapekey_name, slider_min=0, slider_max=1.0, value=1.0):
     return shapekey
 
 
-def new_shapekey_from_current_vertices(obj, shapekey_name):
+def new_shapekey_from_coords(obj, shapekey_name, coords):
+    """
+    Create the shapekey and write the (N, 3) coords in its data
+    with a single foreach_set. The mesh vertices are not touched.
+    """
     shapekey = new_shapekey(obj, shapekey_name)
-    for i in range(len(obj.data.vertices)):
-        shapekey.data[i].co = obj.data.vertices[i].co
+    shapekey.data.foreach_set("co", np.ascontiguousarray(coords, dtype=np.float32).ravel())
     return shapekey
 
 
@@ -986,13 +1177,8 @@ def get_vertgroup_verts(obj, vgroup_name):
     g = get_vertgroup_by_name(obj, vgroup_name)
     verts_idxs = []
     if g is not None:
-        for i in range(len(obj.data.vertices)):
-            try:
-                if g.weight(i) > 0:
-                    verts_idxs.append(i)
-            except AttributeError:
-                pass
-                # Blender return an error if the vert is not in group
+        indices, weights = VertexGroupsWeights.from_object(obj).group(vgroup_name)
+        verts_idxs = indices[weights > 0].tolist()
     return verts_idxs
 
 
@@ -1008,20 +1194,156 @@ def set_object_visible(obj):
 
 
 def load_vertices_database(vertices_path):
-    vertices = []
     verts = load_json_data(vertices_path, "Vertices data")
     if verts:
-        for vert_co in verts:
-            vertices.append(mathutils.Vector(vert_co))
+        vertices = np.array(verts, dtype=np.float32).reshape(-1, 3)
+    else:
+        vertices = np.empty((0, 3), dtype=np.float32)
+    vertices.flags.writeable = False
     return vertices
 
 
+def get_vertices_coords(vertices):
+    """
+    Return the coordinates of a vertices collection (mesh
+    vertices or shapekey data) as a (N, 3) float32 array
+    """
+    return get_items_vectors(vertices, "co")
+
+
+def get_items_vectors(items, attribute):
+    """
+    Return a 3D vector attribute (co, normal, center...) of all
+    the items of a collection as a (N, 3) float32 array
+    """
+    vectors = np.empty(len(items) * 3, dtype=np.float32)
+    items.foreach_get(attribute, vectors)
+    return vectors.reshape(-1, 3)
+
+
+def get_polygons_triangles(mesh):
+    """
+    Return the (N, 3) indices of the first three vertices of each
+    polygon, the triangle used by the proxy fitting.
+    """
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    loops_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loops_verts)
+    return loops_verts[loop_starts[:, np.newaxis] + np.arange(3)]
+
+
+def csr_positions(offsets, rows):
+    """
+    Return the positions of the items of the given rows in a
+    CSR layout, concatenated in the order of rows.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    counts = offsets[rows+1] - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
+def get_polygons_verts(mesh):
+    """
+    Return the vertices of all the polygons as the concatenated
+    vertex indices and the (N+1) offsets of each polygon in them.
+    """
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    loops_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loops_verts)
+
+    polygons_offsets = np.zeros(len(loop_totals)+1, dtype=np.int64)
+    np.cumsum(loop_totals, out=polygons_offsets[1:])
+    positions = np.repeat(loop_starts - polygons_offsets[:-1], loop_totals) + np.arange(polygons_offsets[-1])
+    return loops_verts[positions], polygons_offsets
+
+
+def get_triangles_normals(triangles):
+    """
+    Return the unit normals of the (N, 3, 3) triangles and the
+    length of their cross products (twice the areas).
+    """
+    cross = np.cross(triangles[:, 1]-triangles[:, 0], triangles[:, 2]-triangles[:, 0])
+    length = np.linalg.norm(cross, axis=1)
+    return cross/np.where(length > 0, length, 1.0)[:, np.newaxis], length
+
+
+def get_barycentric_weights(points, triangles, normals):
+    corners = triangles - points[:, np.newaxis, :]
+    weights = np.stack((
+        np.einsum('ij,ij->i', np.cross(corners[:, 1], corners[:, 2]), normals),
+        np.einsum('ij,ij->i', np.cross(corners[:, 2], corners[:, 0]), normals),
+        np.einsum('ij,ij->i', np.cross(corners[:, 0], corners[:, 1]), normals)), axis=1)
+    weights_sum = weights.sum(axis=1)
+    degenerate = weights_sum == 0
+    weights[degenerate] = 1.0/3.0
+    weights[~degenerate] /= weights_sum[~degenerate][:, np.newaxis]
+    return weights
+
+
+def barycentric_transform(points, source_triangles, target_triangles):
+    """
+    Vectorized mathutils.geometry.barycentric_transform: move each
+    point from the (N, 3, 3) source triangles to the target ones.
+    The barycentric weights are taken on the source plane, the
+    distance from the plane is scaled by the square root of the
+    areas ratio and applied along the target normal.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    source_triangles = np.asarray(source_triangles, dtype=np.float64)
+    target_triangles = np.asarray(target_triangles, dtype=np.float64)
+
+    source_normals, source_length = get_triangles_normals(source_triangles)
+    target_normals, target_length = get_triangles_normals(target_triangles)
+    weights = get_barycentric_weights(points, source_triangles, source_normals)
+    result = np.einsum('ij,ijk->ik', weights, target_triangles)
+
+    source_area = np.sqrt(source_length/2)
+    target_area = np.sqrt(target_length/2)
+    z_offsets = np.einsum('ij,ij->i', points-source_triangles[:, 0], source_normals)
+    scale = np.divide(target_area, source_area, out=np.zeros_like(source_area), where=source_area > 0)
+    result += target_normals*(z_offsets*scale)[:, np.newaxis]
+    return result
+
+
+def barycentric_bind(points, triangles):
+    """
+    Return the barycentric weights of the points projected on the
+    (N, 3, 3) triangles and their distance from the triangle plane,
+    as used by barycentric_transform.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.float64)
+    normals = get_triangles_normals(triangles)[0]
+    weights = get_barycentric_weights(points, triangles, normals)
+    offsets = np.einsum('ij,ij->i', points-triangles[:, 0], normals)
+    return weights, offsets
+
+
+def barycentric_unbind(weights, offsets, triangles):
+    """
+    The inverse of barycentric_bind: the points at the barycentric
+    weights and normal offsets on the (N, 3, 3) triangles.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    normals = get_triangles_normals(triangles)[0]
+    return np.einsum('ij,ijk->ik', weights, triangles) + normals*offsets[:, np.newaxis]
+
+
+def set_vertices_coords(vertices, coords):
+    coords = np.ascontiguousarray(coords, dtype=np.float32)
+    vertices.foreach_set("co", coords.ravel())
+
+
 def set_verts_coords_from_file(obj, vertices_path):
     new_vertices = load_vertices_database(vertices_path)
     if obj:
         if len(new_vertices) == len(obj.data.vertices):
-            for i, vert in enumerate(obj.data.vertices):
-                vert.co = new_vertices[i]
+            set_vertices_coords(obj.data.vertices, new_vertices)
 
 
 def generate_items_list(folderpath, file_type="json"):
@@ -1445,13 +1767,10 @@ def get_boundary_verts(obj):
 
 def get_object_groups(obj):
     obj_groups = {}
-    for grp in obj.vertex_groups:
-        weights = []
-        for idx in range(len(obj.data.vertices)):
-            try:
-                if grp.weight(idx) > 0:
-                    weights.append([idx, grp.weight(idx)])
-            except AttributeError:
-                pass
-        obj_groups[grp.name] = weights
+    vgroups = VertexGroupsWeights.from_object(obj)
+    for group_name in vgroups.names:
+        indices, weights = vgroups.group(group_name)
+        in_group = weights > 0
+        obj_groups[group_name] = [
+            [idx, weight] for idx, weight in zip(indices[in_group].tolist(), weights[in_group].tolist())]
     return obj_groups
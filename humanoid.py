@@ -160,9 +160,10 @@ class Humanoid:
     The humanoid is a container for categories of modifiers.
     """
 
-    def __init__(self, lab_version):
+    def __init__(self, lab_version, proxy_engine=None):
 
         self.lab_vers = list(lab_version)
+        self.proxy_engine = proxy_engine
         self.has_data = False
         self.obj_name = ""
         self.data_path = algorithms.get_data_path()
@@ -225,6 +226,10 @@ class Humanoid:
 
         self.corrective_modifier_name = "mbastlab_corrective_modifier"
         self.morph_engine = morphengine.MorphingEngine(self.obj_name, self.characters_config[character_identifier])
+        self.characters_store_paths = set(
+            os.path.normpath(folder_path) for folder_path in (
+                self.phenotypes_path, self.presets_path, self.morph_engine.bodies_data_path)
+            if os.path.isdir(folder_path))
         self.mat_engine = materialengine.MaterialEngine(self.obj_name, self.characters_config[character_identifier])
         self.character_data = {}
         self.character_metaproperties = {"last_character_age":0.0,
@@ -239,7 +244,7 @@ class Humanoid:
         self.material_realtime_activated = True
         self.transformations_data = {}
 
-        for morph in self.morph_engine.morph_data.keys():
+        for morph in self.morph_engine.get_morph_names():
             self.init_character_data(morph)
 
         logger.info("从变形数据库加载了 {0} 类别".format(
@@ -396,16 +401,14 @@ class Humanoid:
                 wished_measures["body_height_Z"] = total_height_Z
 
             if use_measures_from_current_obj:
-                current_shape_verts = []
-                for vert in obj.data.vertices:
-                    current_shape_verts.append(vert.co.copy())
+                current_shape_verts = algorithms.get_vertices_coords(obj.data.vertices)
                 wished_measures = self.morph_engine.calculate_measures(vert_coords=current_shape_verts)
 
             if use_measures_from_dict:
                 wished_measures = use_measures_from_dict
 
             self.morph_engine.calculate_proportions(wished_measures)
-            similar_characters_data  = self.morph_engine.compare_data_proportions()
+            similar_characters_data  = self.morph_engine.compare_data_proportions(n_samples)
 
             best_character = similar_characters_data[0]
             filepath = best_character[1]
@@ -422,7 +425,7 @@ class Humanoid:
             logger.info("人体在 {0} 秒内适配".format(time.time()-time2))
 
     def clean_verts_to_process(self):
-        self.morph_engine.verts_to_update.clear()
+        self.morph_engine.clear_verts_to_update()
 
     def update_displacement(self):
         obj = self.get_object()
@@ -656,10 +659,13 @@ class Humanoid:
         self.morph_engine.init_final_form()
 
 
-    def sync_gui_according_measures(self):
+    def sync_gui_according_measures(self, changed_only=False):
 
         obj = self.get_object()
-        measures = self.morph_engine.calculate_measures()
+        if changed_only:
+            measures = self.morph_engine.calculate_changed_measures()
+        else:
+            measures = self.morph_engine.calculate_measures()
         convert_to_inch = getattr(obj, "mblab_use_inch", False)
         if convert_to_inch:
             conversion_factor = 39.37001
@@ -667,12 +673,27 @@ class Humanoid:
             conversion_factor = 100
         for measure_name,measure_val in measures.items():
             if hasattr(obj, measure_name):
-                setattr(obj, measure_name, measure_val*conversion_factor)
+                measure_val = measure_val*conversion_factor
+                if abs(getattr(obj, measure_name) - measure_val) > 0.0001:
+                    setattr(obj, measure_name, measure_val)
+
+    def finish_preview_update(self):
+        """
+        Complete the updates done in "update_preview" mode, fitting
+        the skeleton and the measures to the current shape.
+        """
+        self.sk_engine.fit_joints()
+        self.sync_gui_according_measures()
 
     def update_bendy_muscles(self):
         armat = self.get_armature()
         algorithms.update_bendy_bones(armat)
 
+    def fit_proxy(self, changed_verts=None):
+        scn = bpy.context.scene
+        if self.proxy_engine and scn.mblab_proxy_live_refit:
+            self.proxy_engine.refit_proxies(self.get_object(), changed_verts)
+
     def update_character(self, category_name = None, mode = "update_all"):
         time1 = time.time()
         obj = self.get_object()
@@ -688,7 +709,7 @@ class Humanoid:
             update_geometry_selective = False
             update_armature = True
             update_normals = True
-            update_proxy = False
+            update_proxy = True
             update_measures = True
             sync_morphdata = False
             sync_GUI = True
@@ -701,7 +722,7 @@ class Humanoid:
             update_geometry_selective = False
             update_armature = True
             update_normals = True
-            update_proxy = False
+            update_proxy = True
             update_measures = True
             sync_morphdata = False
             sync_GUI = True
@@ -714,7 +735,7 @@ class Humanoid:
             update_geometry_selective = False
             update_armature = True
             update_normals = True
-            update_proxy = False
+            update_proxy = True
             update_measures = True
             sync_morphdata = False
             sync_GUI = True
@@ -734,13 +755,26 @@ class Humanoid:
             sync_GUI_metadata = False
             sync_GUI_materials = False
 
+        if mode == "update_preview":
+            update_directly_verts = False
+            update_geometry_all = False
+            update_geometry_selective = True
+            update_armature = False
+            update_normals = False
+            update_proxy = True
+            update_measures = False
+            sync_morphdata = True
+            sync_GUI = False
+            sync_GUI_metadata = False
+            sync_GUI_materials = False
+
         if mode == "update_realtime":
             update_directly_verts = False
             update_geometry_all = False
             update_geometry_selective = True
             update_armature = True
             update_normals = False
-            update_proxy = False
+            update_proxy = True
             update_measures = False
             sync_morphdata = True
             sync_GUI = False
@@ -762,9 +796,7 @@ class Humanoid:
                         modifier.sync_modifier_data_to_obj_prop(self.character_data)
                     self.combine_morphings(modifier)
             else:
-                for category in self.get_categories():
-                    for modifier in category.get_modifiers():
-                        self.combine_morphings(modifier, add_vertices_to_update=True)
+                self.combine_all_morphings()
 
         if update_geometry_all:
             self.morph_engine.update(update_all_verts=True)
@@ -781,11 +813,17 @@ class Humanoid:
         if update_measures:
             self.sync_gui_according_measures()
         if update_armature:
-            self.sk_engine.fit_joints()
+            if update_geometry_selective:
+                self.sk_engine.fit_joints(self.morph_engine.get_verts_to_update())
+            else:
+                self.sk_engine.fit_joints()
         if update_normals:
             obj.data.calc_normals()
         if update_proxy:
-            self.fit_proxy()
+            if update_geometry_selective:
+                self.fit_proxy(self.morph_engine.get_verts_to_update())
+            else:
+                self.fit_proxy()
 
         self.set_subd_visibility(subdivision_value)
 
@@ -1043,6 +1081,7 @@ class Humanoid:
             output_file = open(filepath, 'w')
             json.dump(char_data, output_file)
             output_file.close()
+            self.touch_characters_store(filepath)
 
     def export_measures(self, filepath):
         logger.info("Exporting measures to {0}".format(algorithms.simple_path(filepath)))
@@ -1058,6 +1097,34 @@ class Humanoid:
             output_file.close()
 
 
+    def touch_characters_store(self, filepath):
+        """
+        A file overwritten in place doesn't change the mtime of its
+        folder, which keys the packed store in memory: touch the
+        folder so that the store is built again.
+        """
+        folder_path = os.path.dirname(os.path.normpath(filepath))
+        if folder_path in self.characters_store_paths:
+            try:
+                os.utime(folder_path)
+            except OSError:
+                logger.warning("无法更新文件夹 {0}".format(algorithms.simple_path(folder_path)))
+
+    def get_stored_character_data(self, filepath):
+        """
+        Return the data of a lab character file, read from the
+        packed store of its folder. Return None for the files
+        outside the lab folders.
+        """
+        folder_path, filename = os.path.split(os.path.normpath(filepath))
+        name, extension = os.path.splitext(filename)
+        if extension != ".json" or folder_path not in self.characters_store_paths:
+            return None
+        store = algorithms.load_cached_database(folder_path, morphengine.load_characters_store)
+        if name in store:
+            return store.get_character_data(name)
+        return None
+
     def load_character(self, data_source, reset_string = "nothing", reset_unassigned=True, mix=False, update_mode = "update_all"):
 
         obj = self.get_object()
@@ -1065,7 +1132,9 @@ class Humanoid:
 
         if type(data_source) == str:  #TODO: better check of types
             log_msg_type = algorithms.simple_path(data_source)
-            charac_data = algorithms.load_json_data(data_source,"Character data")
+            charac_data = self.get_stored_character_data(data_source)
+            if charac_data is None:
+                charac_data = algorithms.load_json_data(data_source,"Character data")
         else:
             charac_data = data_source
 
@@ -1169,6 +1238,17 @@ class Humanoid:
                     add_vertices_to_update)
 
 
+    def combine_all_morphings(self, add_vertices_to_update=True):
+        """
+        Compute the weights of all the modifiers and rebuild
+        the mesh with a single sparse product.
+        """
+        for category in self.get_categories():
+            for modifier in category.get_modifiers():
+                self.combine_morphings(modifier, refresh_only=True)
+        self.morph_engine.calculate_all_morphs(add_vertices_to_update)
+
+
     def load_obj_prototype(self,obj_name):
 
         obj_path = os.path.join(self.data_path,"shared_objs",obj_name+".obj")
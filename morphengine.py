@@ -25,22 +25,486 @@ import logging
 import os
 import bpy
 
-import mathutils
+import numpy as np
 
 from . import algorithms, proxyengine
 
 import time, json
-import operator
+import itertools
+import hashlib
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+PROPORTION_INDEX_SIZE = 5
+CORRECTED_MORPHS_CACHE_SIZE = 8
+#Below this number of changed verts, update() writes them one by one
+PARTIAL_UPDATE_MAX_VERTS = 512
+
+
+class MorphsMatrix:
+    """
+    Sparse (3N x M) matrix of morph deltas, stored by column.
+    The morph names[j] moves the verts indices[offsets[j]:offsets[j+1]]
+    by the deltas[offsets[j]:offsets[j+1]].
+    """
+
+    def __init__(self, names, offsets, indices, deltas):
+        self.names = names
+        self.offsets = offsets
+        self.indices = indices
+        self.deltas = deltas
+        # The matrices are shared between engines, see load_cached_database
+        for arr in (self.offsets, self.indices, self.deltas):
+            arr.flags.writeable = False
+
+    @classmethod
+    def from_json_data(cls, m_data):
+        names = list(m_data.keys())
+        counts = [len(deltas) for deltas in m_data.values()]
+        offsets = np.zeros(len(names)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        d_data = np.array(list(itertools.chain.from_iterable(m_data.values())), dtype=np.float64).reshape(-1, 4)
+        indices = d_data[:, 0].astype(np.int32)
+        deltas = d_data[:, 1:].astype(np.float32)
+        return cls(names, offsets, indices, deltas)
+
+    @classmethod
+    def load(cls, filepath, use_mmap=True):
+        header, arrays = algorithms.load_arrays_file(filepath, use_mmap)
+        if header and header.get("type") == "morphs":
+            return cls(header["names"], arrays["offsets"], arrays["indices"], arrays["deltas"])
+        return None
+
+    def save(self, filepath):
+        header = {"type": "morphs", "names": self.names}
+        arrays = {"offsets": self.offsets, "indices": self.indices, "deltas": self.deltas}
+        algorithms.save_arrays_file(filepath, header, arrays)
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, col):
+        start = self.offsets[col]
+        end = self.offsets[col+1]
+        return (self.indices[start:end], self.deltas[start:end])
+
+    def product(self, weights, n_verts):
+        """
+        Return the (n_verts, 3) displacement D @ weights. Only the
+        columns with a non zero weight are gathered.
+        """
+        result = np.zeros((n_verts, 3), dtype=np.float32)
+        delta_weights = np.repeat(weights, np.diff(self.offsets))
+        active = delta_weights != 0.0
+        if np.any(active):
+            indices = self.indices[active]
+            delta_weights = delta_weights[active]
+            deltas = self.deltas[active]
+            for axis in range(3):
+                result[:, axis] = np.bincount(
+                    indices,
+                    weights=deltas[:, axis]*delta_weights,
+                    minlength=n_verts)[:n_verts]
+        return result
+
+
+class MeasureStrips:
+    """
+    The measure strips compiled in flat arrays. The segments
+    offsets[m]:offsets[m+1] of starts and ends belong to the
+    measure names[m]. The measures with a name ending in X, Y
+    or Z only count the distance along that axis.
+    """
+
+    def __init__(self, measures_data):
+        self.names = list(measures_data.keys())
+        self.measure_ids = {name: i for i, name in enumerate(self.names)}
+        starts = []
+        ends = []
+        counts = []
+        axis_masks = []
+        for measure_name in self.names:
+            indices = measures_data[measure_name]
+            starts.extend(indices[:-1])
+            ends.extend(indices[1:])
+            counts.append(max(len(indices)-1, 0))
+            axis = measure_name[-1]
+            if axis in ("X", "Y", "Z"):
+                axis_masks.append([float(axis == "X"), float(axis == "Y"), float(axis == "Z")])
+            else:
+                axis_masks.append([1.0, 1.0, 1.0])
+
+        self.starts = np.array(starts, dtype=np.int32)
+        self.ends = np.array(ends, dtype=np.int32)
+        self.offsets = np.zeros(len(self.names)+1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.axis_masks = np.array(axis_masks, dtype=np.float64).reshape(-1, 3)
+        self.segment_masks = np.repeat(self.axis_masks, counts, axis=0)
+        self.segment_measures = np.repeat(np.arange(len(self.names)), counts)
+        self.build_verts_index()
+
+    def build_verts_index(self):
+        """
+        Build the inverted index vertex -> measures: the measures
+        touched by the vertex v are
+        verts_measures[verts_offsets[v]:verts_offsets[v+1]].
+        """
+        verts = np.concatenate((self.starts, self.ends)).astype(np.int64)
+        measures = np.tile(self.segment_measures, 2)
+        if len(verts):
+            n_verts = int(verts.max())+1
+            pairs = np.unique(verts*len(self.names) + measures)
+            verts = pairs // len(self.names)
+            measures = pairs % len(self.names)
+        else:
+            n_verts = 0
+        self.verts_offsets = np.zeros(n_verts+1, dtype=np.int64)
+        np.cumsum(np.bincount(verts, minlength=n_verts), out=self.verts_offsets[1:])
+        self.verts_measures = measures.astype(np.int32)
+
+    def get_measures_of_verts(self, verts_indices):
+        """
+        Return the sorted ids of the measures that use at least
+        one of the given vertices.
+        """
+        verts_indices = np.asarray(verts_indices, dtype=np.int64)
+        verts_indices = verts_indices[verts_indices < len(self.verts_offsets)-1]
+        positions = algorithms.csr_positions(self.verts_offsets, verts_indices)
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(self.verts_measures[positions])
+
+    def __len__(self):
+        return len(self.names)
+
+    def segment_lengths(self, vert_coords, start=0, end=None):
+        segments = slice(start, end)
+        diff = vert_coords[self.starts[segments]].astype(np.float64)
+        diff -= vert_coords[self.ends[segments]]
+        diff *= self.segment_masks[segments]
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def calculate(self, vert_coords, measures_ids=None):
+        """
+        Return the array of all the measures, in the order of names.
+        If measures_ids is given, only these measures are calculated
+        and returned in the same order.
+        """
+        if measures_ids is None:
+            lengths = self.segment_lengths(vert_coords)
+            return np.bincount(self.segment_measures, weights=lengths, minlength=len(self.names))
+        measures_ids = np.asarray(measures_ids, dtype=np.int64)
+        counts = self.offsets[measures_ids+1] - self.offsets[measures_ids]
+        segments = algorithms.csr_positions(self.offsets, measures_ids)
+        diff = vert_coords[self.starts[segments]].astype(np.float64)
+        diff -= vert_coords[self.ends[segments]]
+        diff *= self.segment_masks[segments]
+        lengths = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        return np.bincount(np.repeat(np.arange(len(measures_ids)), counts),
+                           weights=lengths, minlength=len(measures_ids))
+
+    def calculate_measure(self, vert_coords, measure_name):
+        m_id = self.measure_ids[measure_name]
+        return float(np.sum(self.segment_lengths(vert_coords, self.offsets[m_id], self.offsets[m_id+1])))
+
+
+class BoundingBoxes:
+    """
+    The bounding boxes database compiled in an index table: the
+    box of the vertex v is spanned by the six vertices
+    indices[rows[v]], rows[v] is -1 if v has no box.
+    """
+
+    def __init__(self, bbox_data):
+        verts = np.array([int(idx) for idx in bbox_data.keys()], dtype=np.int64)
+        self.indices = np.array(list(bbox_data.values()), dtype=np.int64).reshape(len(verts), 6)
+        self.rows = np.full(int(verts.max())+1 if len(verts) else 0, -1, dtype=np.int32)
+        self.rows[verts] = np.arange(len(verts))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def extents(self, vert_coords, roundness=4):
+        """
+        Return the (n, 3) sizes of all the boxes, NaN for the
+        boxes with some index out of vert_coords.
+        """
+        result = np.full((len(self.indices), 3), np.nan)
+        valid = np.all(self.indices < len(vert_coords), axis=1)
+        if not np.all(valid):
+            logger.warning("{0} bounding boxes have indices out of the vertices".format(np.count_nonzero(~valid)))
+        box_coords = np.asarray(vert_coords)[self.indices[valid]]
+        result[valid] = np.round(np.ptp(box_coords, axis=1), roundness)
+        return result
+
+    @staticmethod
+    def scales(current_extents, base_extents):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(base_extents != 0, current_extents/base_extents, 1.0)
+
+    def correct_morph(self, morph_deltas, scales):
+        """
+        Scale each delta by the box scales of its vertex. The deltas
+        of the vertices without box are kept as they are, the ones
+        with an invalid box are removed.
+        """
+        morph_indices, deltas = morph_deltas
+        rows = np.full(len(morph_indices), -1, dtype=np.int64)
+        in_table = morph_indices < len(self.rows)
+        rows[in_table] = self.rows[morph_indices[in_table]]
+        has_box = rows >= 0
+        if not np.all(has_box):
+            logger.warning("{0} indices are not in the bounding box database".format(np.count_nonzero(~has_box)))
+        delta_scales = np.ones((len(morph_indices), 3))
+        delta_scales[has_box] = scales[rows[has_box]]
+        keep = ~np.isnan(delta_scales[:, 0])
+        return (morph_indices[keep], (deltas[keep]*delta_scales[keep]).astype(np.float32))
+
+
+class CorrectedMorphsCache:
+    """
+    LRU cache of the corrected morphs, with one entry for each body
+    shape, identified by the hash of its bounding box scales. An
+    entry is a dict morph name -> (indices, deltas).
+    """
+
+    def __init__(self, max_size=CORRECTED_MORPHS_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def get_key(bbox_scales):
+        return hashlib.sha1(np.ascontiguousarray(bbox_scales).tobytes()).hexdigest()
+
+    def get_entry(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        entry = {}
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+
+def load_bounding_boxes(bounding_box_path):
+    bbox_data = algorithms.load_json_data(bounding_box_path, "Bounding box data")
+    return BoundingBoxes(bbox_data or {})
+
+
+def compile_morphs_database(morph_data_path):
+    """
+    Convert a json morph database in the binary format
+    read by load_morphs_matrix. Return the new matrix.
+    """
+    m_data = algorithms.load_json_data(morph_data_path,"Morph data")
+    if not m_data:
+        return None
+    matrix = MorphsMatrix.from_json_data(m_data)
+    try:
+        matrix.save(algorithms.get_compiled_path(morph_data_path))
+    except OSError:
+        logger.warning("Unable to write the compiled database of {0}".format(algorithms.simple_path(morph_data_path)))
+    return matrix
+
+
+def compile_all_morphs_databases():
+    data_path = algorithms.get_data_path()
+    for folder in ("morphs", "expressions_morphs"):
+        folder_path = os.path.join(data_path, folder)
+        for database_file in sorted(os.listdir(folder_path)):
+            if os.path.splitext(database_file)[1] == ".json":
+                compile_morphs_database(os.path.join(folder_path, database_file))
+
+
+def load_morphs_matrix(morph_data_path):
+    """
+    Load the memory-mapped binary version of a morph database,
+    building it from the json file if it's missing or outdated.
+    """
+    compiled_path = algorithms.get_compiled_path(morph_data_path)
+    if algorithms.is_compiled_file_valid(morph_data_path, compiled_path):
+        matrix = MorphsMatrix.load(compiled_path)
+        if matrix is not None:
+            return matrix
+    return compile_morphs_database(morph_data_path)
+
+
+class CharactersStore:
+    """
+    All the character files of a folder packed in dense arrays.
+    values[c, p] is the structural property properties[p] of the
+    character names[c], NaN if the file doesn't define it. The
+    proportion_index rows of the files without it are NaN too.
+    """
+
+    def __init__(self, names, properties, values, proportions, characters_info):
+        self.names = list(names)
+        self.properties = list(properties)
+        self.values = values
+        self.proportions = proportions
+        self.characters_info = characters_info
+        self.character_ids = {name: i for i, name in enumerate(self.names)}
+        for arr in (self.values, self.proportions):
+            arr.flags.writeable = False
+
+    @classmethod
+    def from_folder(cls, folder_path):
+        names = []
+        characters_data = []
+        for database_file in sorted(os.listdir(folder_path)):
+            name, extension = os.path.splitext(database_file)
+            if extension == ".json":
+                char_data = algorithms.load_json_data(os.path.join(folder_path, database_file), "Character data")
+                if isinstance(char_data, dict):
+                    names.append(name)
+                    characters_data.append(char_data)
+
+        properties = sorted(set(itertools.chain.from_iterable(
+            char_data.get("structural", {}).keys() for char_data in characters_data)))
+        property_ids = {prop: i for i, prop in enumerate(properties)}
+        values = np.full((len(names), len(properties)), np.nan, dtype=np.float64)
+        proportions = np.full((len(names), PROPORTION_INDEX_SIZE), np.nan, dtype=np.float64)
+        characters_info = []
+        for c_id, char_data in enumerate(characters_data):
+            for prop, value in char_data.get("structural", {}).items():
+                values[c_id, property_ids[prop]] = value
+            if len(char_data.get("proportion_index", [])) == PROPORTION_INDEX_SIZE:
+                proportions[c_id] = char_data["proportion_index"]
+            characters_info.append({key: value for key, value in char_data.items()
+                                    if key not in ("structural", "proportion_index")})
+        return cls(names, properties, values, proportions, characters_info)
+
+    @classmethod
+    def load(cls, filepath, use_mmap=True):
+        header, arrays = algorithms.load_arrays_file(filepath, use_mmap)
+        #The stores written with float32 values are built again
+        if header and header.get("type") == "characters" and arrays["values"].dtype == np.float64:
+            return cls(header["names"], header["properties"], arrays["values"],
+                       arrays["proportions"], header["characters_info"])
+        return None
+
+    def save(self, filepath):
+        header = {
+            "type": "characters",
+            "names": self.names,
+            "properties": self.properties,
+            "characters_info": self.characters_info}
+        arrays = {"values": self.values, "proportions": self.proportions}
+        algorithms.save_arrays_file(filepath, header, arrays)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.character_ids
+
+    def get_structural_data(self, name):
+        row = self.values[self.character_ids[name]]
+        defined = np.flatnonzero(~np.isnan(row))
+        return dict(zip([self.properties[i] for i in defined], row[defined].tolist()))
+
+    def get_character_data(self, name):
+        """
+        Return the character as it's stored in its json file.
+        """
+        c_id = self.character_ids[name]
+        char_data = dict(self.characters_info[c_id])
+        char_data["structural"] = self.get_structural_data(name)
+        if not np.isnan(self.proportions[c_id, 0]):
+            char_data["proportion_index"] = self.proportions[c_id].tolist()
+        return char_data
+
+
+def compile_characters_store(folder_path):
+    """
+    Pack the json characters of a folder in the binary file
+    read by load_characters_store. Return the new store.
+    """
+    store = CharactersStore.from_folder(folder_path)
+    try:
+        store.save(algorithms.get_compiled_path(folder_path))
+    except OSError:
+        logger.warning("Unable to write the compiled characters of {0}".format(algorithms.simple_path(folder_path)))
+    return store
+
+
+def load_characters_store(folder_path):
+    """
+    Load the packed characters of a folder, building the file
+    if it's missing or older than the folder or one of its json
+    files (that is, when some file has been added, removed or
+    changed).
+    """
+    compiled_path = algorithms.get_compiled_path(folder_path)
+    if algorithms.is_compiled_file_valid(folder_path, compiled_path):
+        store = CharactersStore.load(compiled_path)
+        if store is not None:
+            return store
+    return compile_characters_store(folder_path)
+
+
+class ProportionsIndex:
+    """
+    The proportion_index vectors of all the characters of a folder,
+    stored in one array to find the most similar ones in a single
+    pass. The row i belongs to filepaths[i].
+    """
+
+    def __init__(self, filepaths, proportions):
+        self.filepaths = list(filepaths)
+        self.proportions = np.array(proportions, dtype=np.float64).reshape(len(self.filepaths), -1)
+
+    @classmethod
+    def from_characters_store(cls, store, folder_path):
+        filepaths = []
+        rows = []
+        for c_id, name in enumerate(store.names):
+            filepath = os.path.join(folder_path, name+".json")
+            if np.isnan(store.proportions[c_id, 0]):
+                logger.info("File {0} does not contain proportions".format(algorithms.simple_path(filepath)))
+            else:
+                filepaths.append(filepath)
+                rows.append(c_id)
+        return cls(filepaths, store.proportions[rows])
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def query(self, proportion_index, n_results=None):
+        """
+        Return the list of (distance, filepath) of the n_results
+        characters nearest to proportion_index, sorted by distance.
+        """
+        if len(self.filepaths) == 0:
+            return []
+        deltas = self.proportions - np.asarray(proportion_index, dtype=np.float64)
+        distances = np.sqrt(np.einsum('ij,ij->i', deltas, deltas))
+        if n_results is not None and 0 < n_results < len(distances):
+            nearest = np.argpartition(distances, n_results-1)[:n_results]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [(float(distances[i]), self.filepaths[i]) for i in nearest]
+
+
+def load_proportions_index(folder_path):
+    store = algorithms.load_cached_database(folder_path, load_characters_store)
+    return ProportionsIndex.from_characters_store(store, folder_path)
+
+
 class MorphingEngine:
 
-    def __init__(self, obj_name, character_config):
+    def __init__(self, obj_name, character_config, lazy_loading=True):
         time1 = time.time()
         data_path = algorithms.get_data_path()
-        self.final_form = []
-        self.cache_form = []
+        self.lazy_loading = lazy_loading
+        self.final_form = None
+        self.cache_form = None
         self.obj_name = obj_name
 
         self.vertices_filename = character_config["name"]+"_verts.json"
@@ -100,15 +564,19 @@ class MorphingEngine:
             if os.path.isfile(self.measures_data_path):
                 self.measures_database_exist = True
 
-        self.verts_to_update = set()
+        self.verts_to_update = np.zeros(0, dtype=bool)
         self.morph_data = {}
         self.morph_data_cache = {}
+        self.morph_matrices = []
+        self.morph_catalog = {}
         self.forma_data = None
-        self.bbox_data = {}
+        self.bounding_boxes = BoundingBoxes({})
+        self.bbox_base_extents = None
+        self.corrected_morphs_cache = CorrectedMorphsCache()
         self.morph_values = {}
-        self.morph_modified_verts = {}
         self.boundary_verts = None
         self.measures_data = {}
+        self.measure_strips = MeasureStrips(self.measures_data)
         self.measures_relat_data = []
         self.measures_score_weights = {}
         self.body_height_Z_parts = {}
@@ -117,7 +585,8 @@ class MorphingEngine:
         self.proportion_index = None
 
         self.init_final_form()
-        self.base_form = algorithms.load_vertices_database(self.vertices_path)
+        self.base_form = algorithms.load_cached_database(self.vertices_path, algorithms.load_vertices_database)
+        self.verts_to_update = np.zeros(len(self.base_form), dtype=bool)
 
         self.load_morphs_database(self.shared_morph_data_path)
         self.load_morphs_database(self.morph_data_path)
@@ -139,12 +608,10 @@ class MorphingEngine:
 
     def init_final_form(self):
         obj = self.get_object()
-        self.final_form = []
-        for vert in obj.data.vertices:
-                self.final_form.append(vert.co.copy())
+        self.final_form = algorithms.get_vertices_coords(obj.data.vertices)
 
     def __repr__(self):
-        return "MorphEngine {0} with {1} morphings".format(self.obj_name, len(self.morph_data))
+        return "MorphEngine {0} with {1} morphings".format(self.obj_name, len(self.morph_catalog))
 
     def get_object(self):
         if self.obj_name in bpy.data.objects:
@@ -155,44 +622,71 @@ class MorphingEngine:
         logger.warning("Database file not found: {0}".format(algorithms.simple_path(path)))
 
     def reset(self, update=True):
-        for i in range(len(self.base_form)):
-            self.final_form[i] = self.base_form[i]
+        self.final_form[:] = self.base_form
         for morph_name in self.morph_values.keys():
             self.morph_values[morph_name] = 0.0
         if update:
             self.update(update_all_verts=True)
 
     def load_measures_database(self, measures_path):
-        m_database = algorithms.load_json_data(measures_path,"Measures data")
+        m_database = algorithms.load_cached_database(measures_path, algorithms.load_json_data, "Measures data")
         if m_database:
             self.measures_data = m_database["measures"]
             self.measures_relat_data = m_database["relations"]
             self.measures_score_weights = m_database["score_weights"]
             self.body_height_Z_parts = m_database["body_height_Z_parts"]
+            self.measure_strips = MeasureStrips(self.measures_data)
 
     def load_bboxes_database(self, bounding_box_path):
-        self.bbox_data = algorithms.load_json_data(bounding_box_path,"Bounding box data")
+        self.bounding_boxes = algorithms.load_cached_database(bounding_box_path, load_bounding_boxes)
+        self.bbox_base_extents = None
+        self.corrected_morphs_cache.clear()
 
     #TODO: This loads the morphs
     def load_morphs_database(self, morph_data_path):
+        """
+        The morphs of a file are stacked in a MorphsMatrix. Each morph
+        is a pair of arrays taken from it: the int32 indices of the
+        modified verts and the (k, 3) float32 deltas.
+        """
         time1 = time.time()
-        m_data = algorithms.load_json_data(morph_data_path,"Morph data") #calls algorithms.py
-        if m_data:
-            for morph_name, deltas in m_data.items():
-                morph_deltas = []
-                modified_verts = set()
-                for d_data in deltas:
-                    t_delta = mathutils.Vector(d_data[1:])
-                    morph_deltas.append([d_data[0], t_delta])
-                    modified_verts.add(d_data[0])
-                if morph_name in self.morph_data:
-                    logger.warning("Morph {0} duplicated while loading morphs from file".format(morph_name))
-
-                self.morph_data[morph_name] = morph_deltas
-                self.morph_values[morph_name] = 0.0
-                self.morph_modified_verts[morph_name] = modified_verts
+        matrix = algorithms.load_cached_database(morph_data_path, load_morphs_matrix)
+        if matrix is not None:
+            self.add_morphs_matrix(matrix)
             logger.info("Morph database {0} loaded in {1} secs".format(algorithms.simple_path(morph_data_path),time.time()-time1))
-            logger.info("Now local morph data contains {0} elements".format(len(self.morph_data)))
+            logger.info("Now local morph data contains {0} elements".format(len(self.morph_catalog)))
+
+    def add_morphs_matrix(self, matrix):
+        """
+        Add the morphs of the matrix to the catalog. In lazy mode
+        the deltas of a morph are read only when it's used.
+        """
+        self.morph_matrices.append(matrix)
+        for col, morph_name in enumerate(matrix.names):
+            if morph_name in self.morph_catalog:
+                logger.warning("Morph {0} duplicated while loading morphs from file".format(morph_name))
+
+            self.morph_catalog[morph_name] = (matrix, col)
+            self.morph_values[morph_name] = 0.0
+            self.morph_data.pop(morph_name, None)
+            if not self.lazy_loading:
+                self.morph_data[morph_name] = matrix.column(col)
+
+    def get_morph_names(self):
+        return self.morph_catalog.keys()
+
+    def get_morph_data(self, morph_name):
+        """
+        Return the (indices, deltas) arrays of the morph. The first
+        time, in lazy mode, they are copied from the on-disk matrix.
+        """
+        if morph_name not in self.morph_data:
+            if morph_name not in self.morph_catalog:
+                return None
+            matrix, col = self.morph_catalog[morph_name]
+            morph_indices, morph_deltas = matrix.column(col)
+            self.morph_data[morph_name] = (np.array(morph_indices), np.array(morph_deltas))
+        return self.morph_data[morph_name]
 
 
     #def apply_finishing_morph(self):
@@ -210,21 +704,30 @@ class MorphingEngine:
 
     def calculate_measures(self,measure_name = None,vert_coords=None):
 
-        if not vert_coords:
+        if vert_coords is None:
             vert_coords = self.final_form
-        measures = {}
+        vert_coords = np.asarray(vert_coords, dtype=np.float32)
         time1 = time.time()
         if measure_name:
             if measure_name in self.measures_data:
-                indices =  self.measures_data[measure_name]
-                axis = measure_name[-1]
-                return algorithms.length_of_strip(vert_coords, indices, axis) #check algorithms.py
+                return self.measure_strips.calculate_measure(vert_coords, measure_name)
         else:
-            for measure_name in self.measures_data.keys():
-                measures[measure_name] = self.calculate_measures(measure_name, vert_coords)
+            values = self.measure_strips.calculate(vert_coords)
+            measures = dict(zip(self.measure_strips.names, values.tolist()))
             logger.debug("Measures calculated in {0} secs".format(time.time()-time1))
             return measures
 
+    def calculate_changed_measures(self):
+        """
+        Calculate only the measures that use some of the vertices
+        in verts_to_update.
+        """
+        measures_ids = self.measure_strips.get_measures_of_verts(self.get_verts_to_update())
+        if len(measures_ids) == 0:
+            return {}
+        values = self.measure_strips.calculate(self.final_form, measures_ids)
+        return {self.measure_strips.names[m_id]: value for m_id, value in zip(measures_ids.tolist(), values.tolist())}
+
     def calculate_proportions(self, measures):
 
         if measures == None:
@@ -246,27 +749,12 @@ class MorphingEngine:
             logger.error("The 'body_height_Z' measure not present in the analyzed database")
 
 
-    def compare_file_proportions(self,filepath):
-        char_data = algorithms.load_json_data(filepath,"Proportions data")
-        if "proportion_index" in char_data:
-            v1 = mathutils.Vector(self.proportion_index)
-            v2 = mathutils.Vector(char_data["proportion_index"])
-            delta_v = v2-v1
-
-            return (delta_v.length,filepath)
-        else:
-            logger.info("File {0} does not contain proportions".format(algorithms.simple_path(filepath)))
-
-
-    def compare_data_proportions(self):
+    def compare_data_proportions(self, n_results=None):
         scores = []
         time1 = time.time()
         if os.path.isdir(self.bodies_data_path):
-            for database_file in os.listdir(self.bodies_data_path):
-                body_data, extension = os.path.splitext(database_file)
-                if "json" in extension:
-                    scores.append(self.compare_file_proportions(os.path.join(self.bodies_data_path,database_file)))
-            scores.sort(key=operator.itemgetter(0), reverse=False)
+            proportions_index = algorithms.load_cached_database(self.bodies_data_path, load_proportions_index)
+            scores = proportions_index.query(self.proportion_index, n_results)
             logger.info("Measures compared with database in {0} seconds".format(time.time()-time1))
         else:
             logger.warning("Bodies database not found")
@@ -277,27 +765,37 @@ class MorphingEngine:
 
     def correct_morphs(self, names):
         morph_values_cache = {}
-        for morph_name in self.morph_data.keys():
+        for morph_name in self.morph_catalog.keys():
             for name in names:
                 if name in morph_name:
                     morph_values_cache[morph_name] = self.morph_values[morph_name]#Store the values before the correction
                     self.calculate_morph(morph_name, 0.0) #Reset the morphs to correct
 
-        for morph_name, morph_deltas in self.morph_data.items():
+        time1 = time.time()
+        if self.bbox_base_extents is None:
+            self.bbox_base_extents = self.bounding_boxes.extents(self.base_form)
+        bbox_scales = self.bounding_boxes.scales(
+            self.bounding_boxes.extents(self.final_form),
+            self.bbox_base_extents)
+        corrected_morphs = self.corrected_morphs_cache.get_entry(
+            CorrectedMorphsCache.get_key(bbox_scales))
+
+        for morph_name in self.morph_catalog.keys():
             for name in names:
                 if name in morph_name: #If the morph is in the list of morph to correct
                     if morph_name in self.morph_data_cache:
                         morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
                     else:
-                        self.morph_data_cache[morph_name] = morph_deltas
+                        self.morph_data_cache[morph_name] = self.get_morph_data(morph_name)
                         morph_deltas_to_recalculate = self.morph_data_cache[morph_name]
 
-                    self.morph_data[morph_name] = algorithms.correct_morph(
-                        self.base_form,
-                        self.final_form,
-                        morph_deltas_to_recalculate,
-                        self.bbox_data)
-        for morph_name in self.morph_data.keys():
+                    if morph_name not in corrected_morphs:
+                        corrected_morphs[morph_name] = self.bounding_boxes.correct_morph(
+                            morph_deltas_to_recalculate,
+                            bbox_scales)
+                    self.morph_data[morph_name] = corrected_morphs[morph_name]
+        logger.info("Morphs corrected in {0} secs".format(time.time()-time1))
+        for morph_name in self.morph_catalog.keys():
             for name in names:
                 if name in morph_name:
                     self.calculate_morph(
@@ -313,7 +811,7 @@ class MorphingEngine:
 
         obj = self.get_object()
         #Reset all values (for expressions only) and create the basis key
-        for morph_name in self.morph_data.keys():
+        for morph_name in self.morph_catalog.keys():
             if "Expression" in morph_name:
                 self.calculate_morph(morph_name, 0.0)
                 self.update()
@@ -322,25 +820,21 @@ class MorphingEngine:
 
         #Store the character in neutral expression
         obj = self.get_object()
-        stored_vertices = []
-        for vert in obj.data.vertices:
-            stored_vertices.append(mathutils.Vector(vert.co))
+        stored_vertices = algorithms.get_vertices_coords(obj.data.vertices)
 
         logger.info("Storing neutral character...OK")
         counter = 0
-        for morph_name in sorted(self.morph_data.keys()):
+        shapekey_coords = np.empty_like(stored_vertices)
+        for morph_name in sorted(self.morph_catalog.keys()):
             if "Expression" in morph_name:
                 counter += 1
-                self.calculate_morph(morph_name, 1.0)
                 logger.info("Converting {} to shapekey".format(morph_name))
-                self.update(update_all_verts=True)
-                new_sk = algorithms.new_shapekey_from_current_vertices(obj, morph_name)
+                #Bake neutral + delta directly in the key, the mesh stays neutral
+                morph_indices, morph_deltas = self.get_morph_data(morph_name)
+                shapekey_coords[:] = stored_vertices
+                shapekey_coords[morph_indices] += morph_deltas
+                new_sk = algorithms.new_shapekey_from_coords(obj, morph_name, shapekey_coords)
                 new_sk.value = 0
-
-                #Restore the neutral expression
-                for i in range(len(self.final_form)):
-                    self.final_form[i] = stored_vertices[i]
-                self.update(update_all_verts=True)
         logger.info("Successfully converted {0} morphs in shapekeys".format(counter))
 
 
@@ -350,44 +844,88 @@ class MorphingEngine:
         obj = self.get_object()
         vertices = obj.data.vertices
         if update_all_verts == True:
-            for i in range(len(self.final_form)):
-                vertices[i].co = self.final_form[i]
+            algorithms.set_vertices_coords(vertices, self.final_form)
         else:
-            for i in self.verts_to_update:
-                vertices[i].co = self.final_form[i]
+            verts_indices = self.get_verts_to_update()
+            if len(verts_indices) <= PARTIAL_UPDATE_MAX_VERTS:
+                for i in verts_indices.tolist():
+                    vertices[i].co = self.final_form[i]
+            else:
+                current_coords = algorithms.get_vertices_coords(vertices)
+                current_coords[verts_indices] = self.final_form[verts_indices]
+                algorithms.set_vertices_coords(vertices, current_coords)
+
+    def get_verts_to_update(self):
+        """
+        Return the sorted indices of the verts changed since the
+        last clear_verts_to_update.
+        """
+        return np.flatnonzero(self.verts_to_update)
+
+    def clear_verts_to_update(self):
+        self.verts_to_update[:] = False
 
     def copy_in_cache(self):
         obj = self.get_object()
         self.clean_the_cache()
-        vertices = obj.data.vertices
-        for i in range(len(self.final_form)):
-            self.cache_form.append(vertices[i].co.copy())
+        self.cache_form = algorithms.get_vertices_coords(obj.data.vertices)
         logger.info("Mesh cached")
 
     def copy_from_cache(self):
-        if len(self.final_form) == len(self.cache_form):
-            for i in range(len(self.final_form)):
-                self.final_form[i] = self.cache_form[i]
+        if self.cache_form is not None and len(self.final_form) == len(self.cache_form):
+            self.final_form[:] = self.cache_form
             logger.info("Mesh copied from cache")
         else:
             logger.warning("Cached mesh not found")
 
     def clean_the_cache(self):
-        self.cache_form = []
+        self.cache_form = None
+
 
+    def calculate_all_morphs(self, add_vertices_to_update=True):
+        """
+        Rebuild the whole final form from the current morph values,
+        as base_form + D @ weights, instead of applying the morphs
+        one by one.
+        """
+        time1 = time.time()
+        n_verts = len(self.base_form)
+        weights = [np.zeros(len(matrix), dtype=np.float32) for matrix in self.morph_matrices]
+        matrix_ids = {id(matrix): i for i, matrix in enumerate(self.morph_matrices)}
+        loose_morphs = []
+        for morph_name, val in self.morph_values.items():
+            if val == 0.0:
+                continue
+            if morph_name in self.morph_data_cache:
+                #The corrected deltas are no more a column of the loaded matrices
+                loose_morphs.append((morph_name, val))
+            elif morph_name in self.morph_catalog:
+                matrix, col = self.morph_catalog[morph_name]
+                weights[matrix_ids[id(matrix)]][col] = val
+
+        new_form = self.base_form.copy()
+        for matrix, matrix_weights in zip(self.morph_matrices, weights):
+            if np.any(matrix_weights):
+                new_form += matrix.product(matrix_weights, n_verts)
+        for morph_name, val in loose_morphs:
+            morph_indices, morph_deltas = self.morph_data[morph_name]
+            new_form[morph_indices] += morph_deltas*val
+
+        self.final_form[:] = new_form
+        if add_vertices_to_update:
+            self.verts_to_update[:] = True
+        logger.debug("All morphs calculated in {0} secs".format(time.time()-time1))
 
     def calculate_morph(self, morph_name, val, add_vertices_to_update=True):
 
-        if morph_name in self.morph_data:
+        if morph_name in self.morph_catalog:
             real_val = val - self.morph_values[morph_name]
             if real_val != 0.0:
-                morph = self.morph_data[morph_name]
-                for d_data in morph:
-                    i = d_data[0]
-                    delta = d_data[1]
-                    self.final_form[i] = self.final_form[i] + delta*real_val
+                morph_indices, morph_deltas = self.get_morph_data(morph_name)
+                #The indices of a morph are unique, so a fancy-indexed add is a safe scatter-add
+                self.final_form[morph_indices] += morph_deltas*real_val
                 if add_vertices_to_update:
-                    self.verts_to_update = self.verts_to_update.union(self.morph_modified_verts[morph_name])
+                    self.verts_to_update[morph_indices] = True
                 self.morph_values[morph_name] = val
         else:
             logger.debug("Morph data {0} not found".format(morph_name))
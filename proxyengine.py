@@ -23,9 +23,12 @@
 
 import logging
 import os
+import array
+import hashlib
 
 import mathutils
 import bpy
+import numpy as np
 
 from . import algorithms
 
@@ -34,6 +37,166 @@ logger = logging.getLogger(__name__)
 
 
 
+class BasisGeometry:
+    """
+    The geometry of a template body as it is in the library: the
+    vertices coords, the first three vertices of each polygon, the
+    polygon centers and normals.
+    """
+
+    def __init__(self, coords, triangles, centers, normals):
+        self.coords = coords
+        self.triangles = triangles
+        self.centers = centers
+        self.normals = normals
+
+    @classmethod
+    def from_object(cls, obj):
+        return cls(
+            algorithms.get_vertices_coords(obj.data.vertices),
+            algorithms.get_polygons_triangles(obj.data),
+            algorithms.get_items_vectors(obj.data.polygons, "center"),
+            algorithms.get_items_vectors(obj.data.polygons, "normal"))
+
+    @classmethod
+    def load(cls, filepath, use_mmap=True):
+        header, arrays = algorithms.load_arrays_file(filepath, use_mmap)
+        if header and header.get("type") == "basis_geometry":
+            return cls(arrays["coords"], arrays["triangles"], arrays["centers"], arrays["normals"])
+        return None
+
+    def save(self, filepath):
+        header = {"type": "basis_geometry"}
+        arrays = {"coords": self.coords, "triangles": self.triangles, "centers": self.centers, "normals": self.normals}
+        algorithms.save_arrays_file(filepath, header, arrays)
+
+
+def load_basis_geometry(templates_library, template_name):
+    """
+    Return the BasisGeometry of the template. It's read from the
+    library only the first time, then from a file in data/vertices
+    that is rebuilt when the library is newer.
+    """
+    compiled_path = os.path.join(
+        algorithms.get_data_path(), "vertices", template_name+"_basis"+algorithms.ARRAYS_FILE_EXTENSION)
+    if algorithms.is_compiled_file_valid(templates_library, compiled_path):
+        basis_geometry = BasisGeometry.load(compiled_path)
+        if basis_geometry is not None:
+            return basis_geometry
+
+    basis_body = algorithms.import_object_from_lib(templates_library, template_name, stop_import = False)
+    if basis_body is None:
+        return None
+    basis_geometry = BasisGeometry.from_object(basis_body)
+    algorithms.remove_object(basis_body, True, True)
+    try:
+        basis_geometry.save(compiled_path)
+    except OSError:
+        logger.warning("无法保存 {0} 的基础几何数据".format(template_name))
+    return basis_geometry
+
+
+class FittingContext:
+    """
+    The body data shared by all the fitting steps and by the fitting
+    of several proxies: the subset of polygons used for the fitting,
+    the basis and current geometry as arrays and the kdtrees of the
+    polygon centers. It's valid as long as the body keeps its shape.
+    """
+
+    def __init__(self, body, basis_geometry, template_name, polygons_indxs, body_coords, shape_hash):
+        self.body_name = body.name
+        self.template_name = template_name
+        self.shape_hash = shape_hash
+
+        self.current_coords = body_coords
+        self.current_centers = algorithms.get_items_vectors(body.data.polygons, "center")
+        self.current_normals = algorithms.get_items_vectors(body.data.polygons, "normal")
+        self.polygons_verts, self.polygons_offsets = algorithms.get_polygons_verts(body.data)
+        self.verts_tree = None
+
+        self.basis_coords = basis_geometry.coords
+        self.basis_centers = basis_geometry.centers
+        self.basis_normals = basis_geometry.normals
+        self.triangles = basis_geometry.triangles
+
+        #The basis and the current body must have the same topology
+        self.compatible = len(self.basis_centers) == len(self.current_centers)
+
+        #Without a subset, all the polygons are used. The polygons
+        #of an incompatible body can't be matched with the basis ones
+        self.basis_tree = None
+        self.current_tree = None
+        if not self.compatible:
+            self.polygons_indxs = np.zeros(0, dtype=np.int64)
+        elif polygons_indxs is None:
+            self.polygons_indxs = np.arange(len(self.current_centers))
+        else:
+            self.polygons_indxs = np.asarray(polygons_indxs, dtype=np.int64)
+        if self.compatible:
+            self.basis_tree = algorithms.kdtree_from_coords(
+                self.basis_centers[self.polygons_indxs], self.polygons_indxs)
+            self.current_tree = algorithms.kdtree_from_coords(
+                self.current_centers[self.polygons_indxs], self.polygons_indxs)
+
+    def get_verts_tree(self):
+        if self.verts_tree is None:
+            self.verts_tree = algorithms.kdtree_from_coords(self.current_coords)
+        return self.verts_tree
+
+    def get_polygons_verts(self, polygons):
+        return self.polygons_verts[algorithms.csr_positions(self.polygons_offsets, polygons)]
+
+    @staticmethod
+    def get_shape_hash(body_coords):
+        return hashlib.sha1(np.ascontiguousarray(body_coords).tobytes()).hexdigest()
+
+    def is_valid(self, body_name, template_name, shape_hash):
+        return (self.body_name, self.template_name, self.shape_hash) == (body_name, template_name, shape_hash)
+
+
+class ProxyBinding:
+    """
+    Where each vertex of a fitted proxy lies on the body: the first
+    triangle of the nearest body polygon, the barycentric weights of the
+    vertex on it and its distance along the triangle normal. It lets the
+    proxy follow the body changes without a new fitting.
+    """
+
+    def __init__(self, body_name, n_proxy_verts, verts, triangles, weights, offsets):
+        self.body_name = body_name
+        self.n_proxy_verts = n_proxy_verts
+        self.verts = verts
+        self.triangles = triangles
+        self.weights = weights
+        self.offsets = offsets
+
+    @classmethod
+    def from_coords(cls, body_name, proxy_coords, fitting_context):
+        nearest_body_polygons = algorithms.kdtree_find_n(
+            fitting_context.current_tree, proxy_coords, 1)[0][:, 0]
+        verts = np.flatnonzero(nearest_body_polygons >= 0)
+        triangles = fitting_context.triangles[nearest_body_polygons[verts]]
+        weights, offsets = algorithms.barycentric_bind(
+            proxy_coords[verts], fitting_context.current_coords[triangles])
+        return cls(body_name, len(proxy_coords), verts, triangles, weights, offsets)
+
+    def get_bindings_of_verts(self, changed_verts, n_body_verts):
+        """
+        Return the bindings that use at least one of the changed
+        body verts, or all of them if changed_verts is None.
+        """
+        if changed_verts is None:
+            return np.arange(len(self.verts))
+        changed_mask = np.zeros(n_body_verts, dtype=bool)
+        changed_mask[changed_verts] = True
+        return np.flatnonzero(changed_mask[self.triangles].any(axis=1))
+
+    def calculate_coords(self, body_coords, bindings):
+        return algorithms.barycentric_unbind(
+            self.weights[bindings], self.offsets[bindings], body_coords[self.triangles[bindings]])
+
+
 class ProxyEngine:
 
     def __init__(self):
@@ -47,6 +210,8 @@ class ProxyEngine:
         self.corrective_modifier_name = "mbastlab_proxy_smooth_modifier"
         #self.mask_modifier_name = "mbastlab_mask_modifier"
         self.proxy_armature_modifier = "mbastlab_proxy_armature"
+        self.fitting_context = None
+        self.proxies_bindings = {}
 
 
     def update_assets_models(self):
@@ -65,9 +230,11 @@ class ProxyEngine:
         algorithms.append_object_from_library(asset_path, [assetname])
 
 
-    def transfer_weights(self, body, proxy):
+    def transfer_weights(self, body, proxy, body_groups=None, body_kd_tree=None):
 
-        body_kd_tree = algorithms.kdtree_from_mesh_vertices(body.data)
+        body_coords = algorithms.get_vertices_coords(body.data.vertices)
+        if body_kd_tree is None:
+            body_kd_tree = algorithms.kdtree_from_coords(body_coords)
 
         fit_shapekey = algorithms.get_shapekey(proxy, "mbastlab_proxyfit")
         if fit_shapekey:
@@ -75,64 +242,63 @@ class ProxyEngine:
         else:
             proxy_vertices = proxy.data.vertices
             logger.warning("在没有拟合的情况下执行了重量转移（找不到拟合的形状键）")
-
-
-
-        body_verts_weights = [[] for v in body.data.vertices]
-        for gid, grp in enumerate(body.vertex_groups):
-            for idx, w_data in enumerate(body_verts_weights):
-                in_group = gid in [g.group for g in body.data.vertices[idx].groups]
-                w_data.append([grp.name,grp.weight(idx) if in_group else 0])
-
-        for p_idx, proxy_vert in enumerate(proxy_vertices):
-
-            proxy_vert_weights = {}
-            nearest_body_vert = body_kd_tree.find(proxy_vert.co)
-            min_dist =  nearest_body_vert[2]
-
-            nearest_body_verts = body_kd_tree.find_range(proxy_vert.co,min_dist*2)
-
-
-            for nearest_body_vert_data in nearest_body_verts:
-
-                body_vert_idx = nearest_body_vert_data[1]
-                body_vert_dist = nearest_body_vert_data[2]
-
+        proxy_coords = algorithms.get_vertices_coords(proxy_vertices)
+
+        #The body weights as a sparse (V_body x G) matrix stored by vertex
+        if body_groups is None:
+            body_groups = algorithms.VertexGroupsWeights.from_object(body)
+        n_groups = len(body_groups)
+        if n_groups == 0:
+            return
+        rows_offsets, rows_groups, rows_weights = body_groups.get_verts_rows(len(body_coords))
+
+        #The body verts near each proxy vert, weighted by min_dist/dist
+        candidates_proxy = array.array('i')
+        candidates_body = array.array('i')
+        candidates_magnitude = array.array('d')
+        for p_idx, proxy_co in enumerate(proxy_coords.tolist()):
+            min_dist = body_kd_tree.find(proxy_co)[2]
+            for body_co, body_vert_idx, body_vert_dist in body_kd_tree.find_range(proxy_co, min_dist*2):
+                candidates_proxy.append(p_idx)
+                candidates_body.append(body_vert_idx)
                 if body_vert_dist != 0:
-                    magnitude = min_dist/body_vert_dist
+                    candidates_magnitude.append(min_dist/body_vert_dist)
                 else:
-                    magnitude = 1
-
-
-                group_data = body_verts_weights[body_vert_idx]
-
-                for g_data in group_data:
-                    if len(g_data) > 0:
-                        group_name = g_data[0]
-                        vert_weight = g_data[1]
-
-                    if group_name in proxy_vert_weights:
-                        proxy_vert_weights[group_name] += vert_weight*magnitude
-                    else:
-                        proxy_vert_weights[group_name] = vert_weight*magnitude
-
-
-            #Weights normalize
-            weights_sum = 0
-            for vert_weight in proxy_vert_weights.values():
-                weights_sum += vert_weight
-
-            for group_name,vert_weight in proxy_vert_weights.items():
-                proxy_vert_weights[group_name] = vert_weight/weights_sum
-
-
-            for group_name,vert_weight in proxy_vert_weights.items():
-
-                    if group_name not in proxy.vertex_groups:
-                        proxy.vertex_groups.new(name=group_name)
-
-                    g = proxy.vertex_groups[group_name]
-                    g.add([p_idx], vert_weight, 'REPLACE')
+                    candidates_magnitude.append(1.0)
+        candidates_proxy = np.frombuffer(candidates_proxy, dtype=np.int32)
+        candidates_body = np.frombuffer(candidates_body, dtype=np.int32)
+        candidates_magnitude = np.frombuffer(candidates_magnitude, dtype=np.float64)
+
+        #Sparse weighted sum: each candidate brings all the weights of its body vert
+        counts = rows_offsets[candidates_body+1] - rows_offsets[candidates_body]
+        positions = algorithms.csr_positions(rows_offsets, candidates_body)
+        entries_keys = np.repeat(candidates_proxy.astype(np.int64), counts)*n_groups + rows_groups[positions]
+        entries_weights = rows_weights[positions]*np.repeat(candidates_magnitude, counts)
+        proxy_keys, inverse = np.unique(entries_keys, return_inverse=True)
+        proxy_weights = np.bincount(inverse.ravel(), weights=entries_weights)
+        proxy_verts = proxy_keys // n_groups
+        proxy_groups = proxy_keys % n_groups
+
+        #Weights normalize
+        weights_sums = np.bincount(proxy_verts, weights=proxy_weights, minlength=len(proxy_coords))
+        valid = (proxy_weights > 0) & (weights_sums[proxy_verts] > 0)
+        proxy_verts = proxy_verts[valid]
+        proxy_groups = proxy_groups[valid]
+        proxy_weights = proxy_weights[valid]/weights_sums[proxy_verts]
+        order = np.argsort(proxy_groups, kind="stable")
+        proxy_verts = proxy_verts[order]
+        proxy_groups = proxy_groups[order]
+        proxy_weights = proxy_weights[order]
+
+        groups_offsets = np.zeros(n_groups+1, dtype=np.int64)
+        np.cumsum(np.bincount(proxy_groups, minlength=n_groups), out=groups_offsets[1:])
+        for g_id, group_name in enumerate(body_groups.names):
+            if group_name not in proxy.vertex_groups:
+                proxy.vertex_groups.new(name=group_name)
+            g = proxy.vertex_groups[group_name]
+            start = groups_offsets[g_id]
+            end = groups_offsets[g_id+1]
+            algorithms.add_vertgroup_weights(g, proxy_verts[start:end], proxy_weights[start:end])
 
 
     def disable_extra_armature_modfr(self, proxy):
@@ -169,11 +335,37 @@ class ProxyEngine:
         status, proxy, body = self.get_proxy_fitting_ingredients()
         mask_name = "mbastlab_mask_" + proxy.name
         if status == "OK":
+            self.proxies_bindings.pop(proxy.name, None)
             algorithms.remove_shapekeys_all(proxy)
             proxy.matrix_world.identity()
             self.remove_body_mask(body, mask_name)
 
 
+    def refit_proxies(self, body, changed_verts=None):
+        """
+        Move the proxies fitted to the body along with its changes,
+        using the bindings of their last fitting. Only the proxy verts
+        bound to triangles that use the changed body verts are moved.
+        """
+        body_coords = None
+        for proxy_name, binding in list(self.proxies_bindings.items()):
+            if binding.body_name != body.name:
+                continue
+            proxy = algorithms.get_object_by_name(proxy_name)
+            proxy_shapekey = algorithms.get_shapekey(proxy, "mbastlab_proxyfit") if proxy else None
+            if proxy_shapekey is None or len(proxy_shapekey.data) != binding.n_proxy_verts:
+                del self.proxies_bindings[proxy_name]
+                continue
+
+            if body_coords is None:
+                body_coords = algorithms.get_vertices_coords(body.data.vertices)
+            bindings = binding.get_bindings_of_verts(changed_verts, len(body_coords))
+            if len(bindings):
+                shapekey_coords = algorithms.get_vertices_coords(proxy_shapekey.data)
+                shapekey_coords[binding.verts[bindings]] = binding.calculate_coords(body_coords, bindings)
+                algorithms.set_vertices_coords(proxy_shapekey.data, shapekey_coords)
+                proxy.data.update()
+
     def get_proxy_template_design(self, proxy_obj):
 
         g_identifiers1 = ["girl", "woman", "female"]
@@ -234,7 +426,46 @@ class ProxyEngine:
 
         return ["PROXY_NOT_FOUND", None, None]
 
-
+    def get_proxies_fitting_ingredients(self):
+        """
+        The character and all the selected meshes that can be fitted
+        to it, for the batch fitting.
+        """
+        scn = bpy.context.scene
+        character_obj = algorithms.get_object_by_name(scn.mblab_fitref_name)
+        if character_obj == None:
+            return ["CHARACTER_NOT_FOUND", None, None]
+        if not algorithms.is_a_lab_character(character_obj):
+            return ["NO_REFERENCE", None, None]
+        proxies = [obj for obj in bpy.context.selected_objects
+                   if obj.type == 'MESH' and obj != character_obj and not algorithms.is_a_lab_character(obj)]
+        if not proxies:
+            return ["PROXY_NOT_FOUND", None, None]
+        return ["OK", proxies, character_obj]
+
+
+
+    def get_fitting_context(self, body):
+        """
+        Return the fitting context of the body, built again only
+        if the body changed since the last fitting.
+        """
+        body_coords = algorithms.get_vertices_coords(body.data.vertices)
+        shape_hash = FittingContext.get_shape_hash(body_coords)
+        template_name = algorithms.get_template_model(body)
+        if self.fitting_context is None or not self.fitting_context.is_valid(body.name, template_name, shape_hash):
+            basis_geometry = algorithms.load_cached_database(
+                self.templates_library, load_basis_geometry, template_name)
+            if basis_geometry is None:
+                logger.error("无法读取 {0} 的基础几何数据".format(template_name))
+                return None
+            polygons_file = algorithms.get_template_polygons(body)
+            polygons_path = os.path.join(self.data_path,"pgroups",polygons_file)
+            valid_polygons_indxs = algorithms.load_cached_database(
+                polygons_path, algorithms.load_json_data, "用于替代物拟合的多边形子集")
+            self.fitting_context = FittingContext(
+                body, basis_geometry, template_name, valid_polygons_indxs, body_coords, shape_hash)
+        return self.fitting_context
 
     def reset_proxy_shapekey(self,proxy):
         fit_shapekey = algorithms.get_shapekey(proxy, "mbastlab_proxyfit")
@@ -242,172 +473,158 @@ class ProxyEngine:
             algorithms.remove_shapekey(proxy, "mbastlab_proxyfit")
 
 
-    def fit_distant_vertices(self, basis_proxy,basis_body,proxy_shapekey,current_body):
-
-
-        #basis_proxy = proxy in basis shape, without shapekey applied
-        #proxy_shapekey = shapekey to modify as final result
-        #basis_body = body in basis shape, without morphings and armature
-        #current_body = current body shape, with morphing (but not armature) applied
-
-        polygons_file = algorithms.get_template_polygons(current_body)
-        polygons_path = os.path.join(self.data_path,"pgroups",polygons_file)
-        valid_polygons_indxs = algorithms.load_json_data(polygons_path, "Subset of polygons for proxy fitting")
-
-        basis_proxy_vertices = basis_proxy.data.vertices #In Blender obj.data = basis data
-        basis_body_polygons = basis_body.data.polygons
-        current_body_polygons = current_body.data.polygons
-
-        involved_body_polygons_idx = []
-        involved_basis_body_polygons_coords = []
-        involved_current_body_polygons_coords = []
-
-        if len(basis_body_polygons) == len(current_body_polygons):
-            basis_body_tree = algorithms.kdtree_from_obj_polygons(basis_body, valid_polygons_indxs)
-
-            for i,basis_proxy_vert in enumerate(basis_proxy_vertices):
-
-                nearest_body_polygons_data = basis_body_tree.find(basis_proxy_vert.co)
-                body_polygon_index = nearest_body_polygons_data[1]
-                involved_body_polygons_idx.append(body_polygon_index)
-
-
-            for i in involved_body_polygons_idx:
-                basis_body_polygon = basis_body_polygons[i]
-                current_body_polygon = current_body_polygons[i]
-
-                #current_body_polygon.select = True
-
-                involved_basis_body_polygons_coords.append(basis_body_polygon.center)
-                involved_current_body_polygons_coords.append(current_body_polygon.center)
+    def calculate_distant_coords(self, basis_proxy_coords, fitting_context):
 
-            basis_body_bbox = algorithms.get_bounding_box(involved_basis_body_polygons_coords)
-            current_body_bbox = algorithms.get_bounding_box(involved_current_body_polygons_coords)
+        #basis_proxy_coords = proxy in basis shape, without shapekey applied
+        #fitting_context = basis body (without morphings and armature) and
+        #current body (with morphing but not armature) data
 
-            basis_body_center = algorithms.average_center(involved_basis_body_polygons_coords)
-            current_body_center = algorithms.average_center(involved_current_body_polygons_coords)
+        involved_body_polygons_idx = algorithms.kdtree_find_n(
+            fitting_context.basis_tree, basis_proxy_coords, 1)[0][:, 0]
 
-            scaleX = current_body_bbox[0]/basis_body_bbox[0]
-            scaleY = current_body_bbox[1]/basis_body_bbox[1]
-            scaleZ = current_body_bbox[2]/basis_body_bbox[2]
+        involved_basis_body_polygons_coords = fitting_context.basis_centers[involved_body_polygons_idx]
+        involved_current_body_polygons_coords = fitting_context.current_centers[involved_body_polygons_idx]
 
-            scale_bbox = mathutils.Vector((scaleX,scaleY,scaleZ))
+        basis_body_bbox = np.ptp(involved_basis_body_polygons_coords, axis=0)
+        current_body_bbox = np.ptp(involved_current_body_polygons_coords, axis=0)
 
-            for i,basis_proxy_vert in enumerate(basis_proxy_vertices):
-                proxy_shapekey_vert = proxy_shapekey.data[i]
-                basis_radial_vector = basis_proxy_vert.co-basis_body_center
-                scaled_radial_vector = mathutils.Vector((basis_radial_vector[0]*scale_bbox[0],
-                                                        basis_radial_vector[1]*scale_bbox[1],
-                                                        basis_radial_vector[2]*scale_bbox[2]))
+        basis_body_center = involved_basis_body_polygons_coords.mean(axis=0)
+        current_body_center = involved_current_body_polygons_coords.mean(axis=0)
 
-                proxy_shapekey_vert.co = current_body_center + scaled_radial_vector
+        scale_bbox = np.divide(
+            current_body_bbox, basis_body_bbox,
+            out=np.ones(3, dtype=current_body_bbox.dtype), where=basis_body_bbox != 0)
 
+        basis_radial_vectors = basis_proxy_coords - basis_body_center
+        return current_body_center + basis_radial_vectors*scale_bbox
 
 
-    def fit_near_vertices(self, basis_proxy,basis_body,proxy_shapekey,current_body, proxy_threshold = 0.025):
+    def calculate_near_coords(self, basis_proxy_coords, basis_proxy_normals, shapekey_coords, fitting_context, proxy_threshold):
 
-        #basis_proxy = proxy in basis shape, without shapekey applied
-        #proxy_shapekey = shapekey to modify as final result
-        #basis_body = body in basis shape, without morphings and armature
-        #current_body = current body shape, with morphing (but not armature) applied
-
-        polygons_file = algorithms.get_template_polygons(current_body)
-        polygons_path = os.path.join(self.data_path,"pgroups",polygons_file)
-        valid_polygons_indxs = algorithms.load_json_data(polygons_path, "用于替代物拟合的多边形子集")
-
-        basis_proxy_vertices = basis_proxy.data.vertices #In Blender obj.data = basis data
-        basis_body_polygons = basis_body.data.polygons
-        current_body_polygons = current_body.data.polygons
-
-        if len(basis_body_polygons) == len(current_body_polygons):
-            basis_body_tree = algorithms.kdtree_from_obj_polygons(basis_body, valid_polygons_indxs)
-
-            for i,basis_proxy_vert in enumerate(basis_proxy_vertices):
-
-                nearest_body_polygons_data = basis_body_tree.find_n(basis_proxy_vert.co, 25)
-                #basis body vs basis proxy
-                for body_polygons_data in nearest_body_polygons_data:
-                    body_polygon_index = body_polygons_data[1]
-                    body_polygon_dist = body_polygons_data[2] #distance basis_body - basis_proxy
-                    body_polygon = basis_body_polygons[body_polygon_index]
-                    if basis_proxy_vert.normal.dot(body_polygon.normal) > 0:
-                        break
-
-                if proxy_threshold > 0:
-                    f_factor = 1 - ((body_polygon_dist - proxy_threshold)/proxy_threshold)
-                    f_factor = min(f_factor,1)
-                    f_factor = max(f_factor,0)
-                else:
-                    f_factor = 0
-
-                basis_body_verts_coords = algorithms.get_polygon_vertices_coords(basis_body,body_polygon_index)
-                p1 = basis_body_verts_coords[0]
-                p2 = basis_body_verts_coords[1]
-                p3 = basis_body_verts_coords[2]
-
-                raw_body_verts_coords = algorithms.get_polygon_vertices_coords(current_body,body_polygon_index)
-                p4 = raw_body_verts_coords[0]
-                p5 = raw_body_verts_coords[1]
-                p6 = raw_body_verts_coords[2]
-
-                proxy_shapekey_vert = proxy_shapekey.data[i]
-                fitted_vert = mathutils.geometry.barycentric_transform(basis_proxy_vert.co,p1,p2,p3,p4,p5,p6)
-
-                proxy_shapekey_vert.co = proxy_shapekey_vert.co + f_factor*(fitted_vert-proxy_shapekey_vert.co)
+        #basis_proxy_coords, basis_proxy_normals = proxy in basis shape, without shapekey applied
+        #shapekey_coords = the proxy shape to modify as final result
+        #fitting_context = basis body (without morphings and armature) and
+        #current body (with morphing but not armature) data
 
+        #For each proxy vert, the first of the 25 nearest polygons that
+        #faces the same side, or the last one if none of them does
+        nearest_polygons, nearest_dists = algorithms.kdtree_find_n(
+            fitting_context.basis_tree, basis_proxy_coords, 25)
+        found = nearest_polygons >= 0
+        facing = found & (np.einsum(
+            'ij,ikj->ik', basis_proxy_normals, fitting_context.basis_normals[nearest_polygons]) > 0)
+        choice = np.where(
+            np.any(facing, axis=1),
+            np.argmax(facing, axis=1),
+            np.count_nonzero(found, axis=1)-1)
+        fitted_verts = np.flatnonzero(choice >= 0)
+        body_polygons_idx = nearest_polygons[fitted_verts, choice[fitted_verts]]
+        body_polygons_dist = nearest_dists[fitted_verts, choice[fitted_verts]] #distance basis_body - basis_proxy
 
+        if proxy_threshold > 0:
+            f_factors = np.clip(1 - ((body_polygons_dist - proxy_threshold)/proxy_threshold), 0, 1)
+        else:
+            f_factors = np.zeros(len(fitted_verts))
+
+        body_triangles = fitting_context.triangles[body_polygons_idx]
+        fitted_coords = algorithms.barycentric_transform(
+            basis_proxy_coords[fitted_verts],
+            fitting_context.basis_coords[body_triangles],
+            fitting_context.current_coords[body_triangles])
+
+        shapekey_coords = shapekey_coords.copy()
+        shapekey_fitted_coords = shapekey_coords[fitted_verts]
+        shapekey_coords[fitted_verts] = shapekey_fitted_coords + f_factors[:, np.newaxis]*(fitted_coords-shapekey_fitted_coords)
+        return shapekey_coords
+
+    def calculate_fitted_coords(self, basis_proxy_coords, basis_proxy_normals, shapekey_coords, fitting_context, proxy_threshold, offset_factor):
+        """
+        The distant, near and offset fitting steps on the arrays
+        read from the proxy.
+        """
+        if fitting_context.compatible:
+            if len(fitting_context.polygons_indxs):
+                shapekey_coords = self.calculate_distant_coords(basis_proxy_coords, fitting_context)
+            shapekey_coords = self.calculate_near_coords(
+                basis_proxy_coords, basis_proxy_normals, shapekey_coords, fitting_context, proxy_threshold)
+            shapekey_coords = self.calculate_offset_coords(shapekey_coords, fitting_context, offset_factor)
+        return shapekey_coords
 
 
     def fit_proxy_object(self,proxy_offset=0.0, proxy_threshold = 0.5, create_proxy_mask = False, transfer_w = True):
-        scn = bpy.context.scene
         status, proxy, body = self.get_proxy_fitting_ingredients()
         if status == "OK":
-            armat = algorithms.get_linked_armature(body)
+            self.fit_proxy_objects(body, [proxy], proxy_offset, proxy_threshold, create_proxy_mask, transfer_w)
+
+    def fit_proxy_objects(self, body, proxies, proxy_offset=0.0, proxy_threshold = 0.5, create_proxy_mask = False, transfer_w = True):
+        """
+        Fit several proxies to the body in one pass. The body modifiers
+        are disabled once and the fitting context, the body weights and
+        kdtree are shared by all the proxies.
+        """
+        armat = algorithms.get_linked_armature(body)
+        selected_objs_names = algorithms.get_objects_selected_names()
+
+        body_modfs_status = algorithms.get_object_modifiers_visibility(body)
+        algorithms.disable_object_modifiers(body, ['ARMATURE','SUBSURF','MASK'])
+
+        fitting_context = self.get_fitting_context(body)
+        if fitting_context is None:
+            algorithms.set_object_modifiers_visibility(body, body_modfs_status)
+            return
+
+        proxies_modfs_status = []
+        proxies_shapekeys = []
+        fitting_data = []
+        for proxy in proxies:
             self.calibrate_proxy_object(proxy)
             self.reset_proxy_shapekey(proxy)#Always after calibration!
 
             proxy.matrix_world = body.matrix_world
 
-            template_name = algorithms.get_template_model(body)
-            mask_name = "mbastlab_mask_" + proxy.name
-
             logger.info("正在过滤替代物 {0}".format(proxy.name))
-            selected_objs_names = algorithms.get_objects_selected_names()
-
-            body_modfs_status = algorithms.get_object_modifiers_visibility(body)
-            proxy_modfs_status = algorithms.get_object_modifiers_visibility(proxy)
-
+            proxies_modfs_status.append(algorithms.get_object_modifiers_visibility(proxy))
             algorithms.disable_object_modifiers(proxy, ['ARMATURE','SUBSURF','MASK'])
-            algorithms.disable_object_modifiers(body, ['ARMATURE','SUBSURF','MASK'])
-
-
-            basis_body = algorithms.import_object_from_lib(self.templates_library, template_name, stop_import = False)
 
             proxy_shapekey = algorithms.new_shapekey(proxy,"mbastlab_proxyfit")
-
-
-            self.fit_distant_vertices(proxy,basis_body,proxy_shapekey,body)
-
-            self.fit_near_vertices(proxy,basis_body,proxy_shapekey,body,proxy_threshold)
-            self.proxy_offset(proxy,basis_body,proxy_shapekey,body,proxy_offset)
+            proxies_shapekeys.append(proxy_shapekey)
+            fitting_data.append((
+                algorithms.get_vertices_coords(proxy.data.vertices), #In Blender obj.data = basis data
+                algorithms.get_items_vectors(proxy.data.vertices, "normal"),
+                algorithms.get_vertices_coords(proxy_shapekey.data)))
+
+        proxies_coords = [
+            self.calculate_fitted_coords(*proxy_data, fitting_context, proxy_threshold, proxy_offset)
+            for proxy_data in fitting_data]
+
+        for proxy, proxy_shapekey, proxy_coords in zip(proxies, proxies_shapekeys, proxies_coords):
+            algorithms.set_vertices_coords(proxy_shapekey.data, proxy_coords)
             self.calculate_finishing_morph(proxy, "mbastlab_proxyfit")
+            if fitting_context.compatible:
+                self.proxies_bindings[proxy.name] = ProxyBinding.from_coords(
+                    body.name, algorithms.get_vertices_coords(proxy_shapekey.data), fitting_context)
+            else:
+                self.proxies_bindings.pop(proxy.name, None)
 
+            mask_name = "mbastlab_mask_" + proxy.name
             if create_proxy_mask:
-                self.add_body_mask(body, proxy_shapekey, mask_name)
+                self.add_body_mask(body, proxy_shapekey, mask_name, fitting_context)
             else:
                 self.remove_body_mask(body, mask_name)
 
-            #algorithms.remove_mesh(basis_body_mesh, True)
-            algorithms.remove_object(basis_body, True, True)
+        #Read after the masks, as the single fitting always did
+        if transfer_w == True:
+            body_groups = algorithms.VertexGroupsWeights.from_object(body)
+            body_kd_tree = fitting_context.get_verts_tree()
 
+        for proxy, proxy_modfs_status in zip(proxies, proxies_modfs_status):
             armature_mod = self.add_proxy_armature_modfr(proxy, armat)
 
             if transfer_w == True:
                 algorithms.remove_vertgroups_all(proxy)
-                self.transfer_weights(body, proxy)
+                self.transfer_weights(body, proxy, body_groups, body_kd_tree)
 
             algorithms.set_object_modifiers_visibility(proxy, proxy_modfs_status)
-            algorithms.set_object_modifiers_visibility(body, body_modfs_status)
             self.disable_extra_armature_modfr(proxy)
 
             parameters = {"show_viewport":True}
@@ -421,94 +638,49 @@ class ProxyEngine:
             for i in range(10):
                 algorithms.move_up_modifier(proxy, armature_mod)
 
+        algorithms.set_object_modifiers_visibility(body, body_modfs_status)
 
-            for obj_name in selected_objs_names:
-                algorithms.select_object_by_name(obj_name)
-
-
-
-
+        for obj_name in selected_objs_names:
+            algorithms.select_object_by_name(obj_name)
 
-    def proxy_offset(self, basis_proxy,basis_body,proxy_shapekey,current_body,offset_factor):
 
-        #basis_proxy = proxy in basis shape, without shapekey applied
-        #proxy_shapekey = shapekey of actual, "real" proxy shape to modify as final result
-        #basis_body = body in basis shape, without morphings and armature
-        #current_body = raw copy of current body shape, with morphing and armature applied
+    def calculate_offset_coords(self, shapekey_coords, fitting_context, offset_factor):
 
-        basis_proxy_vertices = basis_proxy.data.vertices
-        basis_body_polygons = basis_body.data.polygons
-        current_body_polygons = current_body.data.polygons
+        #shapekey_coords = actual, "real" proxy shape to modify as final result
+        #fitting_context = current body data, with morphing applied
 
-        polygons_file = algorithms.get_template_polygons(current_body)
-        polygons_path = os.path.join(self.data_path, "pgroups", polygons_file)
-        valid_polygons_indxs = algorithms.load_json_data(polygons_path, "用于替代物拟合的多边形子集")
+        nearest_body_polygons = algorithms.kdtree_find_n(
+            fitting_context.current_tree, shapekey_coords, 10)[0]
 
-        if len(basis_body_polygons) == len(current_body_polygons):
+        #raw body vs proxy shapekey: the average normal of the nearest polygons
+        found = nearest_body_polygons >= 0
+        body_normals = fitting_context.current_normals[nearest_body_polygons]*found[:, :, np.newaxis]
+        offset_vectors = body_normals.sum(axis=1)/np.maximum(found.sum(axis=1), 1)[:, np.newaxis]
+        return shapekey_coords + offset_vectors*offset_factor
 
-            #current_body_tree = algorithms.kdtree_from_mesh_polygons(current_body)
-            current_body_tree = algorithms.kdtree_from_obj_polygons(current_body, valid_polygons_indxs)
 
-            for i in range(len(basis_proxy_vertices)):
-                proxy_shapekey_vert = proxy_shapekey.data[i]
-                nearest_body_polygons_data = current_body_tree.find_n(proxy_shapekey_vert.co, 10)
-                body_normals = []
+    def add_body_mask(self, body, proxy_shapekey, mask_name, fitting_context, proxy_threshold = 0.025):
 
-                #raw body vs proxy shapekey
-                for body_polygons_data in nearest_body_polygons_data:
-                    body_polygon_index = body_polygons_data[1]
-                    body_polygon_dist = body_polygons_data[2] #distance body-proxy
-                    body_polygon = current_body_polygons[body_polygon_index]
-                    body_polygon_normal = body_polygon.normal
-                    body_polygon_center = body_polygon.center
-                    body_normals.append(body_polygon_normal)
-
-                offset_vector = mathutils.Vector((0,0,0))
-                for n in body_normals:
-                    offset_vector += n
-
-                if len(body_normals) != 0:
-                    offset_vector = offset_vector/len(body_normals)
-                proxy_shapekey_vert.co = proxy_shapekey_vert.co + offset_vector*offset_factor
-
-
-    def add_body_mask(self, body, proxy_shapekey, mask_name, proxy_threshold = 0.025):
-
-        #basis_proxy_mesh = proxy in basis shape, without shapekey applied
         #proxy_shapekey = shapekey of actual, "real" proxy shape as it is after the fitting
-        #basis_body_mesh = body in basis shape, without morphings and armature
         #body = actual body to modify as final result
-
-        polygons_file = algorithms.get_template_polygons(body)
-        polygons_path = os.path.join(self.data_path,"pgroups",polygons_file)
-        valid_polygons_indxs = algorithms.load_json_data(polygons_path, "用于替代物拟合的多边形子集")
-        body_tree = algorithms.kdtree_from_obj_polygons(body, valid_polygons_indxs)
-
+        #fitting_context = the data of the body as it is now
 
         algorithms.remove_vertgroup(body, mask_name)
 
-        masked_verts_idx = set()
+        masked_verts = np.zeros(len(fitting_context.current_coords), dtype=bool)
         mask_group = algorithms.new_vertgroup(body, mask_name)
 
-        for actual_vert in proxy_shapekey.data:
-
-            nearest_body_polygon_data = body_tree.find(actual_vert.co)
-            involved_vertices = set()
-            dist_proxy_body = nearest_body_polygon_data[2]
-            body_polygon_idx = nearest_body_polygon_data[1]
-            body_polygon = body.data.polygons[body_polygon_idx]
-
-            #body_polygon.select = True
-
-            if dist_proxy_body < proxy_threshold:
-                for v_idx in body_polygon.vertices:
-                    masked_verts_idx.add(v_idx)
+        if len(fitting_context.polygons_indxs):
+            shapekey_coords = algorithms.get_vertices_coords(proxy_shapekey.data)
+            nearest_body_polygons, dists_proxy_body = algorithms.kdtree_find_n(
+                fitting_context.current_tree, shapekey_coords, 1)
+            near_polygons = np.unique(nearest_body_polygons[dists_proxy_body < proxy_threshold])
+            masked_verts[fitting_context.get_polygons_verts(near_polygons)] = True
 
-        algorithms.less_boundary_verts(body, masked_verts_idx, iterations=2)
+        algorithms.less_boundary_verts_mask(
+            masked_verts, fitting_context.polygons_verts, fitting_context.polygons_offsets, iterations=2)
 
-        for i,vert in enumerate(body.data.vertices):
-            if i in masked_verts_idx:
-                mask_group.add([vert.index], 1.0, 'REPLACE')
+        mask_group.add(np.flatnonzero(masked_verts).tolist(), 1.0, 'REPLACE')
 
         #self.add_mask_modifier(body, mask_name)
         parameters = {"vertex_group":mask_name,"invert_vertex_group":True}
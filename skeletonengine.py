@@ -22,9 +22,12 @@
 
 import logging
 import os
+import itertools
+import json
 
 import bpy
 import mathutils
+import numpy as np
 
 from . import algorithms
 from .utils import get_object_parent
@@ -32,6 +35,52 @@ from .utils import get_object_parent
 logger = logging.getLogger(__name__)
 
 
+class JointsVerts:
+    """
+    The joints database compiled in flat arrays: the location of
+    the joint names[j] is the mean of the verts
+    indices[offsets[j]:offsets[j+1]], moved by deltas[j].
+    """
+
+    def __init__(self, joints_data, joints_offset_data=None):
+        self.names = list(joints_data.keys())
+        self.name_ids = {name: i for i, name in enumerate(self.names)}
+        counts = [len(joints_data[name]) for name in self.names]
+        self.offsets = np.zeros(len(self.names)+1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.indices = np.array(list(itertools.chain.from_iterable(
+            joints_data[name] for name in self.names)), dtype=np.int64)
+        self.joint_ids = np.repeat(np.arange(len(self.names)), counts)
+        self.counts = np.maximum(np.array(counts, dtype=np.float64), 1.0)
+        self.deltas = np.zeros((len(self.names), 3))
+        if joints_offset_data:
+            for name, delta in joints_offset_data.items():
+                if name in self.name_ids:
+                    self.deltas[self.name_ids[name]] = delta
+        self.verts_mask = np.zeros(int(self.indices.max())+1 if len(self.indices) else 0, dtype=bool)
+        self.verts_mask[self.indices] = True
+
+    def __contains__(self, name):
+        return name in self.name_ids
+
+    def uses_verts(self, verts_indices):
+        verts_indices = np.asarray(verts_indices, dtype=np.int64)
+        verts_indices = verts_indices[verts_indices < len(self.verts_mask)]
+        return bool(np.any(self.verts_mask[verts_indices]))
+
+    def locations(self, vert_coords):
+        """
+        Return the (n, 3) locations of all the joints.
+        """
+        joint_coords = np.asarray(vert_coords, dtype=np.float64)[self.indices]
+        result = np.empty((len(self.names), 3))
+        for axis in range(3):
+            result[:, axis] = np.bincount(
+                self.joint_ids, weights=joint_coords[:, axis], minlength=len(self.names))
+        result /= self.counts[:, np.newaxis]
+        return result + self.deltas
+
+
 class SkeletonEngine:
     armature_modifier_name = "mbastlab_armature"
 
@@ -66,8 +115,11 @@ class SkeletonEngine:
             vgroup_data_path = os.path.join(self.data_path, "vgroups", self.groups_filename)
 
             self.lib_filepath = algorithms.get_blendlibrary_path()
-            self.joints_database = algorithms.load_json_data(joints_data_path, "Joints data")
-            self.joints_offset_database = algorithms.load_json_data(joints_offset_data_path, "Joints offset data")
+            joints_database = algorithms.load_cached_database(
+                joints_data_path, algorithms.load_json_data, "Joints data")
+            joints_offset_database = algorithms.load_cached_database(
+                joints_offset_data_path, algorithms.load_json_data, "Joints offset data")
+            self.joints_verts = JointsVerts(joints_database or {}, joints_offset_database)
 
             if self.check_skeleton(obj_body):
                 obj_armat = get_object_parent(obj_body)
@@ -126,6 +178,20 @@ class SkeletonEngine:
         logger.error("找不到数据库文件：%s", algorithms.simple_path(path))
 
     def store_z_axis(self):
+        """
+        Read the z axis of the bones of the native armature. They are
+        saved in a small table next to the joints data the first time,
+        so the armature is imported from the library only when the
+        table is missing or older than the library.
+        """
+        z_axis_path = os.path.join(self.data_path, "joints", self.skeleton_template_name+"_z_axis.json")
+        if algorithms.is_compiled_file_valid(self.lib_filepath, z_axis_path):
+            z_axis_data = algorithms.load_json_data(z_axis_path, "Bones z axis data")
+            if z_axis_data:
+                self.armature_z_axis = {
+                    bone_name: mathutils.Vector(z_axis) for bone_name, z_axis in z_axis_data.items()}
+                return
+
         logger.info("导入临时原始骨架以存储 z 轴")
         native_armature = algorithms.import_object_from_lib(
             self.lib_filepath, self.skeleton_template_name, "temp_armature")
@@ -133,6 +199,15 @@ class SkeletonEngine:
         if native_armature:
             self.armature_z_axis = algorithms.get_all_bones_z_axis(native_armature)
             algorithms.remove_object(native_armature)
+            self.save_z_axis(z_axis_path)
+
+    def save_z_axis(self, filepath):
+        z_axis_data = {bone_name: list(z_axis) for bone_name, z_axis in self.armature_z_axis.items()}
+        try:
+            with open(filepath, 'w') as output_file:
+                json.dump(z_axis_data, output_file)
+        except OSError:
+            logger.warning("无法将骨骼 z 轴保存到 %s", algorithms.simple_path(filepath))
 
     def align_bones_z_axis(self):
         target_armature = self.get_armature()
@@ -148,26 +223,12 @@ class SkeletonEngine:
     def load_groups(self, filepath, use_weights=True, clear_all=True):
         if self.has_data:
             obj = self.get_body()
-            g_data = algorithms.load_json_data(filepath, "Vertgroups data")
+            vgroups = algorithms.load_cached_database(filepath, algorithms.load_vertgroups_database)
 
             if clear_all:
                 algorithms.remove_vertgroups_all(obj)
-            if g_data:
-                group_names = sorted(g_data.keys())
-                for group_name in group_names:
-                    new_group = algorithms.new_vertgroup(obj, group_name)
-                    for vert_data in g_data[group_name]:
-                        if use_weights:
-                            if isinstance(vert_data, list):
-                                new_group.add([vert_data[0]], vert_data[1], 'REPLACE')
-                            else:
-                                logger.info("错误：垂直权重格式错误")
-                        else:
-                            if isinstance(vert_data, int):
-                                new_group.add([vert_data], 1.0, 'REPLACE')
-                            else:
-                                logger.info("错误：顶点组的格式错误")
-
+            if vgroups:
+                vgroups.add_to_object(obj, use_weights)
                 logger.info("从 %s 加载的组", algorithms.simple_path(filepath))
             else:
                 logger.warning("Vgroup file problem %s", algorithms.simple_path(filepath))
@@ -187,20 +248,19 @@ class SkeletonEngine:
         body = self.get_body()
         return body and armat
 
-    @staticmethod
-    def calculate_joint_location(obj, vertsindex_list):
-        joint_verts_coords = []
-        for v_idx in vertsindex_list:
-            vert = obj.data.vertices[v_idx]
-            joint_verts_coords.append(vert.co)
-        return algorithms.average_center(joint_verts_coords)
-
-    def fit_joints(self):
-
+    def fit_joints(self, changed_verts=None):
+        """
+        Move the bones to the joints locations. If changed_verts is
+        given, the fitting is skipped when no joint uses them.
+        """
         armat = self.get_armature()
         body = self.get_body()
 
         if armat and body:
+            if changed_verts is not None and not self.joints_verts.uses_verts(changed_verts):
+                return
+            joints_locations = self.joints_verts.locations(
+                algorithms.get_vertices_coords(body.data.vertices))
             algorithms.set_object_visible(armat)
             logger.debug("正在适配骨架 %s", armat.name)
             armat.data.use_mirror_x = False
@@ -211,23 +271,11 @@ class SkeletonEngine:
                 tail_name = "".join((e_bone.name, "_tail"))
                 head_name = "".join((e_bone.name, "_head"))
 
-                if tail_name in self.joints_database:
-                    tail_location = self.calculate_joint_location(body, self.joints_database[tail_name])
-
-                    if self.joints_offset_database:
-                        if tail_name in self.joints_offset_database:
-                            tail_delta = mathutils.Vector(self.joints_offset_database[tail_name])
-                            tail_location += tail_delta
-                    e_bone.tail = tail_location
-
-                if head_name in self.joints_database:
-                    head_location = self.calculate_joint_location(body, self.joints_database[head_name])
+                if tail_name in self.joints_verts:
+                    e_bone.tail = joints_locations[self.joints_verts.name_ids[tail_name]]
 
-                    if self.joints_offset_database:
-                        if head_name in self.joints_offset_database:
-                            head_delta = mathutils.Vector(self.joints_offset_database[head_name])
-                            head_location += head_delta
-                    e_bone.head = head_location
+                if head_name in self.joints_verts:
+                    e_bone.head = joints_locations[self.joints_verts.name_ids[head_name]]
 
             algorithms.select_and_change_mode(armat, "OBJECT")
             self.align_bones_z_axis()